@@ -0,0 +1,130 @@
+from graph import Graph, Node
+from model_cache import NodeTable, CachedModel, CachedLayers, unpack_string
+from functools import cached_property
+from typing import Callable
+import numpy as np
+
+HALVES = ["top", "bottom"]
+
+# Node attributes of a frozen model as arrays indexed by node id, so that walkers and analyses look codes up instead
+# of reading node data: type codes, model layer, half (index into HALVES) and randomizer layer, -1 where a node doesn't
+# have the attribute. Monte Carlo product nodes have the ids of their top and bottom components instead, whose attributes are in
+# components. A cached model's attributes are decoded from the model cache's columns up front, nothing per node. A
+# built model's are read from its nodes one column at a time, the first time the column is asked for, so that e.g.
+# the halves of a Las Vegas model never compute a tape or a name
+class NodeAttributes:
+    def __init__(self, nodes: list[Node] = None, layers: list[list[Node]] = ()):
+        self.nodes = nodes
+        self.layers = layers
+
+    # the attributes of model from the columns of its nodes and components in the model cache
+    @staticmethod
+    def from_tables(model: Graph, table: NodeTable, component_table: NodeTable) -> 'NodeAttributes':
+        attributes = NodeAttributes(layers=getattr(model, 'layers', []))
+        attributes.set_columns(table)
+        attributes.components = None
+        if len(component_table):
+            attributes.components = NodeAttributes()
+            attributes.components.set_columns(component_table)
+            attributes.components.components = None
+        return attributes
+
+    def set_columns(self, table: NodeTable):
+        self.type_names: list[str] = table.types
+        self.type = np.asarray(table.arrays['type'])
+        self.half = decoded_column(table, 'half', HALVES.index, np.int8)
+        self.randomizer_layer = decoded_column(table, 'layer', int, np.int32)
+        self.top = column_codes(table, 'top')
+        self.bottom = column_codes(table, 'bottom')
+
+    def __len__(self) -> int:
+        return len(self.type)
+
+    def type_code(self, type_name: str) -> int:
+        return self.type_names.index(type_name) if type_name in self.type_names else -1
+
+    # the columns of a built model, each computed from the nodes when it is first read
+    _types = cached_property(lambda self: node_types(self.nodes))
+    type_names = cached_property(lambda self: self._types[0])
+    type = cached_property(lambda self: self._types[1])
+    half = cached_property(lambda self: node_column(self.nodes, 'half', HALVES.index, np.int8))
+    randomizer_layer = cached_property(lambda self: node_column(self.nodes, 'layer', int, np.int32)) # data['layer'] is only on randomizer nodes
+    _references = cached_property(lambda self: node_references(self.nodes))
+    top = cached_property(lambda self: self._references[0])
+    bottom = cached_property(lambda self: self._references[1])
+    components = cached_property(lambda self: self._references[2])
+
+    # index of the model layer of every node. a cached model's layers are read from its layer arrays, no node is made
+    @cached_property
+    def layer(self) -> np.ndarray:
+        layer = np.full(len(self), -1, dtype=np.int32)
+        if isinstance(self.layers, CachedLayers):
+            layer[self.layers.node_ids] = np.repeat(np.arange(len(self.layers), dtype=np.int32), np.diff(self.layers.offsets))
+            return layer
+        for i, nodes in enumerate(self.layers):
+            layer[[node.id for node in nodes]] = i
+        return layer
+
+def column_codes(table: NodeTable, key: str) -> np.ndarray:
+    if key not in table.columns:
+        return np.full(len(table), -1, dtype=np.int32)
+    return np.asarray(table.arrays[f'data.{key}.codes'])
+
+# the distinct values a column's codes point at, decoded (references are left out, their codes are their ids)
+def column_values(table: NodeTable, key: str) -> list:
+    match table.columns.get(key):
+        case 'str':
+            offsets = table.arrays[f'data.{key}.offsets']
+            return [unpack_string(table.arrays[f'data.{key}.bytes'], offsets, i) for i in range(len(offsets) - 1)]
+        case 'int':
+            return table.arrays[f'data.{key}.values'].tolist()
+        case _:
+            return []
+
+# a column's codes replaced by decode(value), -1 where the node doesn't have the key
+def decoded_column(table: NodeTable, key: str, decode: Callable, dtype) -> np.ndarray:
+    codes = column_codes(table, key)
+    lookup = np.array([decode(value) for value in column_values(table, key)] + [-1], dtype=dtype)
+    return lookup[codes] # code -1 picks the trailing -1
+
+# the distinct types of the nodes in order of appearance and the index of every node's type among them. the model
+# cache stores the same codes, see model_cache.encode_nodes
+def node_types(nodes: list[Node]) -> tuple[list[str], np.ndarray]:
+    type_names: dict[str, int] = {}
+    codes = np.fromiter((type_names.setdefault(node.type, len(type_names)) for node in nodes), dtype=np.int32, count=len(nodes))
+    return list(type_names), codes
+
+# decode(node.data[key]) of every node, -1 where the node doesn't have the key. only that key of the data is read
+def node_column(nodes: list[Node], key: str, decode: Callable, dtype) -> np.ndarray:
+    decoded = {}
+    def code(node: Node):
+        data = node.data
+        if data is None or key not in data:
+            return -1
+        value = data[key]
+        if value not in decoded:
+            decoded[value] = decode(value)
+        return decoded[value]
+    return np.fromiter(map(code, nodes), dtype=dtype, count=len(nodes))
+
+# ids of the top and bottom component of every product node (-1 for other nodes) and the attributes of the components
+def node_references(nodes: list[Node]) -> tuple[np.ndarray, np.ndarray, NodeAttributes]:
+    ids: dict[Node, int] = {}
+    top, bottom = np.full(len(nodes), -1, dtype=np.int32), np.full(len(nodes), -1, dtype=np.int32)
+    for i, node in enumerate(nodes):
+        data = node.data
+        if data is not None and 'top' in data:
+            top[i] = ids.setdefault(data['top'], len(ids))
+            bottom[i] = ids.setdefault(data['bottom'], len(ids))
+    return top, bottom, NodeAttributes(list(ids)) if ids else None
+
+# the attributes of a frozen model, computed once and kept on the model
+def node_attributes(model: Graph) -> NodeAttributes:
+    if model._node_attributes is not None:
+        return model._node_attributes
+    model.freeze()
+    if isinstance(model, CachedModel):
+        model._node_attributes = NodeAttributes.from_tables(model, model.node_table, model.component_table)
+    else:
+        model._node_attributes = NodeAttributes(model.nodes, getattr(model, 'layers', []))
+    return model._node_attributes
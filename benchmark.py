@@ -0,0 +1,153 @@
+from common import Randomizer, HalfHourglass
+from las_vegas import LasVegasSampler, LasVegasRandomWalk, comp_length_to_output_length_converter
+from montecarlo import MonteCarloSampler, MonteCarloRandomWalk
+from chains import ChainSegments
+from turing_machine import TuringMachine, Rules, longest_computation_path
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import time
+import tracemalloc
+from typing import Callable
+
+# the machines shipped with the repo and the state they start in
+BUNDLED_MACHINES = {"computation.tm": "a", "computation2.tm": "a"}
+
+# seconds f took and what it returned
+def time_it(f) -> tuple[float, object]:
+    start = time.perf_counter()
+    value = f()
+    return time.perf_counter() - start, value
+
+# peak memory allocated by python while running f, in bytes (measured on a separate run, tracing slows f down)
+def peak_memory(f) -> int:
+    tracemalloc.start()
+    try:
+        f()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+# runs f without its progress messages, so that they don't break up the result table
+def quietly(f):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return f()
+
+def walk_steps(walk, steps: int):
+    for _ in range(steps):
+        walk.step()
+
+# runs walk for time, crossing segments in one move when there are segments. returns how many steps that was and in
+# how many iterations of run_for_time (one per step without fast-forward)
+def walk_time(walk, time: float, segments: ChainSegments = None) -> dict:
+    if segments is not None:
+        walk.enable_fast_forward(segments)
+    walk.run_for_time(time)
+    return {"steps": walk.steps, "iterations": walk.moves if segments is not None else walk.steps}
+
+# name -> function to measure, for one machine and number of random bits. the models the walks and analyses run on are
+# built (and frozen) once up front, so those benchmarks only measure the walk or the analysis. functions that return
+# a dict add its entries to the result. the run_for_time walks are long enough for about walk_steps_count steps
+# on the Las Vegas model (hourglass nodes have about 4 neighbors), the same walk with and without fast-forward
+def benchmarks(tm: TuringMachine, random_bits: int, walk_steps_count: int) -> dict[str, Callable[[], object]]:
+    converter = comp_length_to_output_length_converter(random_bits)
+    lv = LasVegasSampler(random_bits, tm).freeze()
+    mc = MonteCarloSampler(random_bits, tm).freeze()
+    lv_segments = ChainSegments(lv, LasVegasRandomWalk(lv, 0).pinned_nodes())
+    mc_segments = ChainSegments(mc, MonteCarloRandomWalk(mc, 0).pinned_nodes())
+    walk_time_count = walk_steps_count / 4
+    return {
+        "Randomizer": lambda: Randomizer(random_bits),
+        "HalfHourglass": lambda: HalfHourglass(Randomizer(random_bits), tm, 'top', converter),
+        "LasVegasSampler": lambda: LasVegasSampler(random_bits, tm),
+        "MonteCarloSampler": lambda: MonteCarloSampler(random_bits, tm),
+        "LasVegasRandomWalk.step": lambda: walk_steps(LasVegasRandomWalk(lv, 0), walk_steps_count),
+        "MonteCarloRandomWalk.step": lambda: walk_steps(MonteCarloRandomWalk(mc, 0), walk_steps_count),
+        "LasVegasRandomWalk.run_for_time": lambda: walk_time(LasVegasRandomWalk(lv, 0), walk_time_count),
+        "LasVegasRandomWalk.run_for_time fast-forward": lambda: walk_time(LasVegasRandomWalk(lv, 0), walk_time_count, lv_segments),
+        "MonteCarloRandomWalk.run_for_time": lambda: walk_time(MonteCarloRandomWalk(mc, 0), walk_time_count),
+        "MonteCarloRandomWalk.run_for_time fast-forward": lambda: walk_time(MonteCarloRandomWalk(mc, 0), walk_time_count, mc_segments),
+        "longest_computation_path": lambda: quietly(lambda: longest_computation_path(tm.rules, tm.state, random_bits)),
+        "LasVegasSampler.stationary_distribution": lambda: lv.stationary_distribution(),
+        "MonteCarloSampler.stationary_distribution": lambda: mc.stationary_distribution(),
+    }
+
+# best of repeats runs, plus peak memory of one more run (unless memory is False)
+def measure(f, repeats: int, memory: bool) -> dict:
+    runs = [time_it(f) for _ in range(repeats)]
+    result = {"seconds": min(seconds for seconds, _ in runs)}
+    if isinstance(runs[-1][1], dict):
+        result.update(runs[-1][1])
+    if memory:
+        result["peak_bytes"] = peak_memory(f)
+    return result
+
+def run_suite(machines: dict[str, str], bit_range: range, repeats: int, memory: bool, walk_steps_count: int, report = print) -> list[dict]:
+    results = []
+    for tm_filename, initial_state in machines.items():
+        tm = TuringMachine(Rules(open(tm_filename, 'r').read()), {}, initial_state)
+        for random_bits in bit_range:
+            for name, f in benchmarks(tm, random_bits, walk_steps_count).items():
+                result = {"machine": os.path.basename(tm_filename), "bits": random_bits, "benchmark": name, **measure(f, repeats, memory)}
+                if name.endswith(".step"):
+                    result["steps_per_second"] = walk_steps_count / result["seconds"]
+                elif "steps" in result:
+                    result["steps_per_second"] = result["steps"] / result["seconds"]
+                results.append(result)
+                report(result)
+    return results
+
+def result_key(result: dict) -> tuple:
+    return (result["machine"], result["bits"], result["benchmark"])
+
+def format_result(result: dict, baseline: dict = None, tolerance: float = 0.1) -> str:
+    line = f"{result['machine']:>16} {result['bits']:>4} {result['benchmark']:<48} {result['seconds']:>10.4f}s"
+    if "peak_bytes" in result:
+        line += f" {result['peak_bytes'] / 2**20:>10.2f}MB"
+    if "iterations" in result:
+        line += f"  {result['steps']} steps in {result['iterations']} iterations"
+    if baseline is not None and result_key(result) in baseline:
+        ratio = result["seconds"] / baseline[result_key(result)]["seconds"]
+        flag = "  slower" if ratio > 1 + tolerance else "  faster" if ratio < 1 - tolerance else ""
+        line += f"  x{ratio:.2f} vs baseline{flag}"
+    return line
+
+def main():
+    parser = argparse.ArgumentParser(prog="python3 benchmark.py",
+        description="Times model construction, walk throughput and analyses against the number of random bits, "
+                    "and optionally compares the results with a stored baseline")
+    parser.add_argument('tm_filename', nargs='?', help = 'Turing machine to benchmark, defaults to the bundled computation.tm and computation2.tm')
+    parser.add_argument('-i', '--tm-initial-state', help = 'the head state to start the Turing machine in (required with tm_filename)')
+    parser.add_argument('--min-random-bits', type=int, default=2, help = 'smallest number of random bits, defaults to 2')
+    parser.add_argument('-b', '--max-random-bits', type=int, default=5, help = 'largest number of random bits, defaults to 5')
+    parser.add_argument('-r', '--repeats', type=int, default=3, help = 'runs per benchmark, the fastest one is reported, defaults to 3')
+    parser.add_argument('--walk-steps', type=int, default=100000, help = 'steps per walk throughput run, defaults to 100000')
+    parser.add_argument('--no-memory', action="store_true", help = 'skip the peak memory runs')
+    parser.add_argument('-o', '--output', help = 'write the results to this JSON file')
+    parser.add_argument('--baseline', help = 'JSON file of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help = 'relative time difference to the baseline that is flagged, defaults to 0.1')
+    args = parser.parse_args()
+
+    if args.tm_filename is not None:
+        if args.tm_initial_state is None:
+            parser.error("--tm-initial-state is required with tm_filename")
+        machines = {args.tm_filename: args.tm_initial_state}
+    else:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        machines = {os.path.join(directory, name): state for name, state in BUNDLED_MACHINES.items()}
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as file:
+            baseline = {result_key(result): result for result in json.load(file)["results"]}
+
+    results = run_suite(machines, range(args.min_random_bits, args.max_random_bits + 1), args.repeats, not args.no_memory,
+                        args.walk_steps, lambda result: print(format_result(result, baseline, args.tolerance), flush=True))
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "results": results}, file, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+from graph import Graph
+from attributes import node_attributes
+from collections import Counter
+import numpy as np
+
+# hops ChainSegments.advance takes one at a time before switching to vectorized blocks. fast-forwarded Las Vegas
+# walks at 6 to 10 bits ran in 35% to 40% of the plain walk's time with 32 to 64, against 80% with no scalar hops
+SCALAR_HOPS = 48
+
+# Maximal runs of interchangeable positions in a frozen undirected graph, used to fast-forward walkers.
+# Nodes with identical neighbor sets (twins, e.g. the two stitched tracks of a computation at the same step)
+# form a class. A class is interior when its neighbors are exactly two other whole classes of equal size:
+# a walker there waits Exp(degree), moves to either side with probability 1/2 and lands uniformly in that
+# class, so only its position along the run matters. Runs of interior classes are the segments, plain
+# degree 2 paths being the special case of classes of size 1. The hourglass runs are short (23 to 58 classes
+# for the bundled machines at 3 to 8 bits), runs of 4 or more cover about 90% of their nodes. Interior classes
+# have one node type, so that the hops inside a segment can be counted per type.
+class ChainSegments:
+    def __init__(self, graph: Graph, pinned: set[int] = frozenset(), min_length: int = 4):
+        if graph.directed:
+            raise Exception("chain segments are only defined for undirected graphs")
+        graph.freeze()
+        indptr, indices = graph.indptr, graph.indices
+        keys: dict[tuple[int, ...], int] = {}
+        class_of = [keys.setdefault(tuple(sorted(indices[indptr[i]:indptr[i + 1]].tolist())), len(keys))
+                    for i in range(len(graph.nodes))]
+        members: list[list[int]] = [[] for _ in keys]
+        for i, c in enumerate(class_of):
+            members[c].append(i)
+        attributes = node_attributes(graph)
+        self.type_names: list[str] = attributes.type_names
+        self.node_types: memoryview = memoryview(attributes.type)
+
+        sides: dict[int, tuple[int, int]] = {}
+        for c, neighbors in enumerate(keys):
+            if len(neighbors) == 0 or any(i in pinned for i in members[c]) or len({self.node_types[i] for i in members[c]}) > 1:
+                continue
+            neighbor_classes = {class_of[j] for j in neighbors}
+            if len(neighbor_classes) != 2:
+                continue
+            a, b = neighbor_classes
+            if len(members[a]) == len(members[b]) and len(members[a]) + len(members[b]) == len(neighbors):
+                sides[c] = (a, b)
+
+        def away_from(c: int, prev: int) -> int:
+            a, b = sides[c]
+            return b if a == prev else a
+
+        self.segment_of = np.full(len(graph.nodes), -1, dtype=np.int32)
+        self.position_of = np.zeros(len(graph.nodes), dtype=np.int32)
+        self.classes: list[list[np.ndarray]] = [] # per segment: left exit, interior positions, right exit
+        self.degrees: list[np.ndarray] = []
+        self.types: list[np.ndarray] = [] # per segment: type code of every interior position
+        seen = set()
+        for c in sides:
+            if c in seen:
+                continue
+            # walk to the left end of the run
+            prev, cur = sides[c][1], c
+            while True:
+                nxt = away_from(cur, prev)
+                if nxt not in sides or nxt == c:
+                    break
+                prev, cur = cur, nxt
+            run, left_exit = [cur], nxt
+            prev = left_exit
+            while True:
+                nxt = away_from(run[-1], prev)
+                if nxt not in sides or nxt == run[0]:
+                    break
+                prev = run[-1]
+                run.append(nxt)
+            seen.update(run)
+            if nxt in sides or len(run) < min_length: # closed loops never exit, leave them to ordinary steps
+                continue
+            segment = len(self.classes)
+            for position, cls in enumerate(run):
+                self.segment_of[members[cls]] = segment
+                self.position_of[members[cls]] = position
+            self.classes.append([np.array(members[cls]) for cls in [left_exit] + run + [nxt]])
+            self.degrees.append(np.array([2 * len(members[sides[cls][0]]) for cls in run], dtype=np.float64))
+            self.types.append(np.array([self.node_types[members[cls][0]] for cls in run], dtype=np.int32))
+        self.degree_lists = [degrees.tolist() for degrees in self.degrees]
+        self.segment_view = memoryview(self.segment_of)
+        self.position_view = memoryview(self.position_of)
+
+    # Moves a walker at node (inside a segment) at the given time until its first hop out of the segment,
+    # or its first hop that ends after target, exactly as repeated RandomWalk.step calls would. Returns the new
+    # node, its time and the number of hops. random is the walker's randomwalk.RandomStream. Half of the walkers
+    # entering at an end leave on their first hop, so the first SCALAR_HOPS hops are taken one at a time from the
+    # stream, and only walkers still inside after them are moved in vectorized blocks, which cost about as much
+    # as SCALAR_HOPS single hops each. With visits, the hops are also counted there by the type of the node they
+    # land on.
+    def advance(self, node: int, time: float, target: float, random, visits: Counter = None) -> tuple[int, float, int]:
+        segment = self.segment_view[node]
+        degrees = self.degree_lists[segment]
+        length = len(degrees)
+        position = self.position_view[node]
+        path = [] if visits is not None else None # positions landed on, when counting
+        steps, u = 0, None
+        while steps < SCALAR_HOPS:
+            u, e = random.next_pair()
+            time += e / degrees[position]
+            steps += 1
+            if u < 0.5:
+                position -= 1
+                u = 2 * u
+            else:
+                position += 1
+                u = 2 * u - 1
+            if position < 0 or position >= length or time > target:
+                break
+            if path is not None:
+                path.append(position)
+        else:
+            generator, degrees = random.generator, self.degrees[segment]
+            block = max(16, 2 * length) # a walker entering at an end leaves after about length hops
+            while True:
+                moves = np.where(generator.random(block) < 0.5, -1, 1)
+                positions = position + np.cumsum(moves)
+                times = time + np.cumsum(generator.standard_exponential(block) / degrees.take(positions - moves, mode='clip'))
+                stops = np.flatnonzero((positions < 0) | (positions >= length) | (times > target))
+                j = int(stops[0]) if len(stops) else block - 1
+                if path is not None:
+                    path.extend(positions[:j].tolist())
+                if len(stops):
+                    position, time, steps = int(positions[j]), float(times[j]), steps + j + 1
+                    break
+                if path is not None:
+                    path.append(int(positions[-1]))
+                position, time, steps = int(positions[-1]), float(times[-1]), steps + block
+                block = min(2 * block, 4096)
+            u = generator.random()
+        landing = self.classes[segment][position + 1]
+        node = int(landing[0] if len(landing) == 1 else landing[int(u * len(landing))])
+        if path is not None:
+            self.count_visits(segment, path, node, visits)
+        return node, time, steps
+
+    # adds the hops onto the interior positions path and the final hop onto node to visits, by node type
+    def count_visits(self, segment: int, path: list[int], node: int, visits: Counter):
+        types = self.types[segment]
+        codes = np.bincount(types[path], minlength=len(self.type_names)) if path else np.zeros(len(self.type_names), dtype=np.int64)
+        codes[self.node_types[node]] += 1
+        for code in np.flatnonzero(codes).tolist():
+            visits[self.type_names[code]] += int(codes[code])
@@ -1,56 +1,119 @@
-from graph import Graph, Node
+from graph import Graph, GraphBuilder, Node
 from turing_machine import TuringMachine
+from trajectory import TrajectoryStore, Trajectory, ComputationData, tape_string
 from typing import Callable
+from collections.abc import Mapping
 
 def binary_string(n: int, bits: int) -> str:
     return ''.join([str((n >> k) & 1) for k in range(bits-1, -1, -1)])
 
+# a node of Randomizer, stored as its layer and its bits as an int. name and data ({'layer', 'bits'} with the bits
+# as a string) are only computed when looked at, e.g. for display
+class RandomizerNode(Node):
+    __slots__ = ('randomizer', 'layer', 'index', 'label')
+
+    def __init__(self, randomizer: 'Randomizer', layer: int, index: int):
+        self.graph = self.randomizer = randomizer
+        self.type = 'randomizer'
+        self.id = -1
+        self.layer = layer
+        self.index = index
+        self.label = None # set once the node is renamed
+
+    @property
+    def name(self) -> str:
+        if self.label is None:
+            return self.randomizer.prefix + str(self.layer * self.randomizer.layer_size + self.index)
+        return self.label
+
+    @name.setter
+    def name(self, name: str):
+        self.label = name
+
+    @property
+    def data(self) -> dict:
+        return {'layer': self.layer, 'bits': format(self.index, f'0{self.randomizer.num_layers}b')}
+
+    # name and data shadow Node's slots, so only the stored attributes are pickled (e.g. for plot.py's workers)
+    def __getstate__(self) -> tuple:
+        return self.graph, self.type, self.id, self.randomizer, self.layer, self.index, self.label
+
+    def __setstate__(self, state: tuple):
+        self.graph, self.type, self.id, self.randomizer, self.layer, self.index, self.label = state
+
+# adj_list of Randomizer, neighbors are computed from the node's layer and bits
+class HypercubeAdjacency(Mapping):
+    def __init__(self, randomizer: 'Randomizer'):
+        self.randomizer = randomizer
+
+    def __getitem__(self, node: Node) -> list[Node]:
+        if node not in self:
+            raise KeyError(node)
+        return self.randomizer.neighbors(node)
+
+    def __contains__(self, node) -> bool:
+        return isinstance(node, RandomizerNode) and node.randomizer is self.randomizer
+
+    def __iter__(self):
+        return (node for layer in self.randomizer.layers for node in layer)
+
+    def __len__(self) -> int:
+        return self.randomizer.num_layers * self.randomizer.layer_size
+
+# (random_bits + 1) layers of 2^(random_bits + 1) nodes, node i of layer l > 0 is joined to nodes i and i with bit
+# l - 1 (from the left) flipped of layer l - 1. the edges are never stored: they are computed with an XOR whenever
+# adj_list is read, e.g. once by the GraphBuilder that merges the randomizer into a HalfHourglass
 class Randomizer(Graph):
-    def __init__(self, random_bits: int):
+    def __init__(self, random_bits: int, prefix: str = ""):
         super().__init__(False)
-        num_layers = random_bits + 1
-        nodes_per_layer = 2 ** num_layers
-        
-        self.layers: list[dict[str, Node]] = [None] * num_layers
-
-        rand_strings = [binary_string(n, num_layers) for n in range(nodes_per_layer)]
-
-        for layer in range(0, num_layers):
-            current_layer = {bstr: self.add_node('randomizer', {'layer': layer, 'bits': bstr}) for bstr in rand_strings}
-            self.layers[layer] = current_layer
-            if layer == 0:
-                continue
-            prev_layer = self.layers[layer - 1]
-            bit_to_change = layer - 1
-            for bstr, node in current_layer.items():
-                self.add_edge(node, prev_layer[bstr])
-                # flip the bit
-                bstr = bstr[:bit_to_change] + str(1 - int(bstr[bit_to_change])) + bstr[bit_to_change + 1:]
-                self.add_edge(node, prev_layer[bstr])
-
-def tape_string(tape: dict) -> str:
-    return ''.join([value for key, value in sorted(tape.items(), key = lambda x: x[0])])
-
-def tm_to_graph(tm: TuringMachine) -> tuple[Graph, Node, Node]:
+        self.random_bits = random_bits
+        self.num_layers = random_bits + 1
+        self.layer_size = 2 ** self.num_layers
+        self.prefix = prefix # of the node names, which are numbered layer by layer
+        self.layers: list[list[RandomizerNode]] = [[RandomizerNode(self, layer, index) for index in range(self.layer_size)]
+                                                   for layer in range(self.num_layers)]
+        self.adj_list = HypercubeAdjacency(self)
+
+    # same order as the randomizer used to store them in: the previous layer, then the next one
+    def neighbors(self, node: RandomizerNode) -> list[RandomizerNode]:
+        layer, index = node.layer, node.index
+        neighbors = []
+        if layer > 0:
+            flipped = index ^ (1 << (self.num_layers - layer))
+            neighbors += [self.layers[layer - 1][index], self.layers[layer - 1][flipped]]
+        if layer < self.num_layers - 1:
+            flipped = index ^ (1 << (self.num_layers - layer - 1))
+            neighbors += [self.layers[layer + 1][min(index, flipped)], self.layers[layer + 1][max(index, flipped)]]
+        return neighbors
+
+    def add_edge(self, node1: Node, node2: Node):
+        raise Exception("the edges of a randomizer are computed, it can't be modified")
+
+    def add_node(self, node_type: str, node_data: dict = None) -> Node:
+        raise Exception("the nodes of a randomizer are computed, it can't be modified")
+
+# with a TrajectoryStore the run is taken from (or added to) the store, otherwise tm is run
+def tm_to_graph(tm: TuringMachine, trajectories: TrajectoryStore = None) -> tuple[Graph, Node, Node]:
+    trajectory = trajectories.get(tm) if trajectories is not None else Trajectory(tm)
     graph = Graph()
-    initial = graph.add_node('computation', {'tape': tape_string(tm.tape), 'head': tm.head_loc, 'state': tm.state})
-    previous = initial
-    while True:
-        if tm.forward(): # when halted
-            break
-        current = graph.add_node('computation', {'tape': tape_string(tm.tape), 'head': tm.head_loc, 'state': tm.state})
-        graph.add_edge(previous, current)
+    previous = None
+    for step in range(len(trajectory)):
+        current = graph.add_node('computation', ComputationData(trajectory, step))
+        if previous is None:
+            initial = current
+        else:
+            graph.add_edge(previous, current)
         previous = current
     previous.type = "output"
     return graph, initial, previous
 
-def computation_and_hold_output(tm: TuringMachine, comp_length_to_output_length: Callable[[int],int]):
-    comp_graph, start, output = tm_to_graph(tm)
+def computation_and_hold_output(tm: TuringMachine, comp_length_to_output_length: Callable[[int],int], trajectories: TrajectoryStore = None):
+    comp_graph, start, output = tm_to_graph(tm, trajectories)
     output_section_length = comp_length_to_output_length(len(comp_graph.adj_list) - 1)
     output.data["counter"] = 0
     prev = output
     for counter in range(1, output_section_length):
-        node = comp_graph.add_node('output', {**output.data, "counter": counter})
+        node = comp_graph.add_node('output', output.data.with_extra(counter = counter))
         comp_graph.add_edge(node, prev)
         prev = node
     return comp_graph, start, prev
@@ -60,25 +123,30 @@ def resize_list(x: list, size: int, default = lambda: None):
         x.append(default())
 
 class HalfHourglass(Graph):
-    def __init__(self, randomizer: Randomizer, computation: TuringMachine, half: str, comp_length_to_output_length: Callable[[int],int]):
+    def __init__(self, randomizer: Randomizer, computation: TuringMachine, half: str, comp_length_to_output_length: Callable[[int],int],
+                 trajectories: TrajectoryStore = None):
         super().__init__(False)
-        self.union(randomizer)
+        # the second track repeats the first track's computation, so it always comes from the store
+        trajectories = trajectories if trajectories is not None else TrajectoryStore()
+        builder = GraphBuilder(self)
+        builder.merge(randomizer)
 
-        self.layers: list[list[Node]] = [list(randomizer_layer.values()) for randomizer_layer in randomizer.layers]
+        self.layers: list[list[Node]] = [list(randomizer_layer) for randomizer_layer in randomizer.layers]
         randomizer_layer_index = -1
         if half == 'bottom':
             randomizer_layer_index = 0
             self.layers = list(reversed(self.layers))
-        random_layer = list(randomizer.layers[randomizer_layer_index].items())
+        random_layer = randomizer.layers[randomizer_layer_index]
 
-        random_layer_consecutive_pairs = [(bstr[:-1], node1, node2) for (bstr, node1), (_, node2) \
-                                           in zip(random_layer[::2], random_layer[1::2])]
+        # nodes 2k and 2k + 1 only differ in their last bit, the input is the other bits, i.e. k
+        random_layer_consecutive_pairs = [(binary_string(k, randomizer.random_bits), random_layer[2 * k], random_layer[2 * k + 1])
+                                          for k in range(len(random_layer) // 2)]
         
         for bstr, random_node_one, random_node_two in random_layer_consecutive_pairs:
             random_tape = {i: c for i, c in enumerate(bstr)}
 
             tm_one = TuringMachine(computation.rules, random_tape, computation.state)
-            comp_output_graph_one, comp_one_start, _ = computation_and_hold_output(tm_one, comp_length_to_output_length)
+            comp_output_graph_one, comp_one_start, _ = computation_and_hold_output(tm_one, comp_length_to_output_length, trajectories)
             resize_list(self.layers, len(randomizer.layers) + len(comp_output_graph_one.adj_list), lambda: [])
             for i, node in enumerate(comp_output_graph_one.adj_list):
                 node.name = f"comp{bstr}_track0_{node.name}"
@@ -86,26 +154,27 @@ class HalfHourglass(Graph):
                     node.data["half"] = half
                 node.data["randomness"] = bstr
                 self.layers[len(randomizer.layers) + i].append(node)
-            self.union(comp_output_graph_one)
-            self.add_edge(random_node_one, comp_one_start)
-            self.add_edge(random_node_two, comp_one_start)
+            builder.merge(comp_output_graph_one)
+            builder.add_edge(random_node_one, comp_one_start)
+            builder.add_edge(random_node_two, comp_one_start)
 
             tm_two = TuringMachine(computation.rules, random_tape, computation.state)
-            comp_output_graph_two, comp_two_start, _ = computation_and_hold_output(tm_two, comp_length_to_output_length)
+            comp_output_graph_two, comp_two_start, _ = computation_and_hold_output(tm_two, comp_length_to_output_length, trajectories)
             for i, node in enumerate(comp_output_graph_two.adj_list):
                 node.name = f"comp{bstr}_track1_{node.name}"
                 if half is not None:
                     node.data["half"] = half
                 node.data["randomness"] = bstr
                 self.layers[len(randomizer.layers) + i].append(node)
-            self.union(comp_output_graph_two)
-            self.add_edge(random_node_one, comp_two_start)
-            self.add_edge(random_node_two, comp_two_start)
+            builder.merge(comp_output_graph_two)
+            builder.add_edge(random_node_one, comp_two_start)
+            builder.add_edge(random_node_two, comp_two_start)
 
             ### STITCH THE TWO COMPUTATIONS TOGETHER
             node_list_one = list(comp_output_graph_one.adj_list)
             for i, node in enumerate(comp_output_graph_two.adj_list):
                 if i > 0:
-                    self.add_edge(node, node_list_one[i - 1])
+                    builder.add_edge(node, node_list_one[i - 1])
                 if i < len(node_list_one) - 1:
-                    self.add_edge(node, node_list_one[i + 1])
\ No newline at end of file
+                    builder.add_edge(node, node_list_one[i + 1])
+        builder.build()
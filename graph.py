@@ -1,39 +1,116 @@
 import numpy as np
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+from collections.abc import Mapping, Iterable, Hashable
+from typing import Callable, TextIO
+import io
 
 class Node:
+    __slots__ = ('graph', 'name', 'type', 'data', 'id')
+
     def __init__(self, graph: 'Graph', node_type: str, data: dict = None, name: str = None):
         self.graph = graph
         self.name = name or str(len(self.graph.adj_list))
         self.type = node_type
         self.data = data
+        self.id = -1 # assigned by Graph.freeze()
 
     def __str__(self) -> str:
         return self.name + " " + self.type + (" " + str(self.data) if self.data else "")
 
+# read-only stand-in for Graph.adj_list once a graph is frozen, neighbor lists are built on demand from the CSR arrays
+class CSRAdjacency(Mapping):
+    def __init__(self, nodes: list[Node], indptr: np.ndarray, indices: np.ndarray):
+        self.nodes = nodes
+        self.indptr = indptr
+        self.indices = indices
+
+    def __getitem__(self, node: Node) -> list[Node]:
+        if node not in self:
+            raise KeyError(node)
+        nodes = self.nodes
+        return [nodes[j] for j in self.indices[self.indptr[node.id]:self.indptr[node.id + 1]].tolist()]
+
+    def __contains__(self, node) -> bool:
+        i = getattr(node, 'id', -1)
+        return 0 <= i < len(self.nodes) and self.nodes[i] is node
+
+    def __iter__(self):
+        return iter(self.nodes)
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
 class Graph:
+    node_class = Node
+
     def __init__(self, directed = False):
         self.adj_list: dict[Node, list[Node]] = {}
         self.directed = directed
+        self.frozen = False
+        self.nodes: list[Node] = None
+        self.indptr: np.ndarray = None
+        self.indices: np.ndarray = None
+        self._node_idxs: dict[Node, int] = None
+        self._transition_operator: sp.csr_matrix = None
+        self._transposed_operator: sp.csr_matrix = None
+        self._generator: sp.csr_matrix = None
+        self._node_attributes = None # see attributes.node_attributes
     
     def add_edge(self, node1: Node, node2: Node):
+        if self.frozen:
+            raise Exception("cannot add an edge to a frozen graph")
         self.adj_list[node1].append(node2)
         if not self.directed:
             self.adj_list[node2].append(node1)
     
     def add_node(self, node_type: str, node_data: dict = None) -> Node:
-        node = Node(self, node_type, node_data)
+        if self.frozen:
+            raise Exception("cannot add a node to a frozen graph")
+        node = self.node_class(self, node_type, node_data)
         self.adj_list[node] = []
         return node
 
+    # one-shot conversion of adj_list into integer node ids + CSR arrays (indptr, indices).
+    # adj_list keeps working as a read-only mapping, but the graph can't be modified afterwards
+    def freeze(self) -> 'Graph':
+        if self.frozen:
+            return self
+        nodes = list(self.adj_list)
+        for i, node in enumerate(nodes):
+            node.id = i
+            node.graph = self # drops references to the temporary graphs the node was built in
+        index_dtype = np.int32 if len(nodes) < 2 ** 31 else np.int64
+        indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter((len(neighbors) for neighbors in self.adj_list.values()), dtype=np.int64, count=len(nodes)),
+                  out=indptr[1:])
+        indices = np.fromiter((neighbor.id for neighbors in self.adj_list.values() for neighbor in neighbors),
+                              dtype=index_dtype, count=indptr[-1])
+        self.nodes, self.indptr, self.indices = nodes, indptr, indices
+        self.adj_list = CSRAdjacency(nodes, indptr, indices)
+        self.frozen = True
+        return self
+
+    def random_node(self, generator: np.random.Generator) -> Node:
+        nodes = self.nodes if self.frozen else list(self.adj_list)
+        return nodes[generator.integers(len(nodes))]
+
+    def degrees(self) -> np.ndarray:
+        if self.frozen:
+            return np.diff(self.indptr)
+        return np.fromiter((len(neighbors) for neighbors in self.adj_list.values()), dtype=np.int64, count=len(self.adj_list))
+
     def union(self, other: 'Graph'):
+        if self.frozen:
+            raise Exception("cannot take the union into a frozen graph")
         if self.directed != other.directed:
             raise Exception("cannot take the union of a directed and an undirected graph")
-        for node in self.adj_list:
-            neighbors = set(self.adj_list.get(node, [])) | set(other.adj_list.get(node, []))
-            self.adj_list[node] = list(neighbors)
-        for node in other.adj_list:
-            if node not in self.adj_list:
-                self.adj_list[node] = other.adj_list[node]
+        # only the nodes of other are touched, so the cost is O(|other|) however large self is
+        for node, neighbors in other.adj_list.items():
+            if node in self.adj_list:
+                self.adj_list[node] = list(dict.fromkeys(self.adj_list[node] + list(neighbors)))
+            else:
+                self.adj_list[node] = list(neighbors)
         
     def __str__(self) -> str:
         output = []
@@ -55,60 +132,231 @@ class Graph:
                 mat[i, j] = 1/denom
         return nodes, node_idxs, mat
     
+    def csr_arrays(self) -> tuple[list[Node], dict[Node, int], np.ndarray, np.ndarray]:
+        if self.frozen:
+            if self._node_idxs is None:
+                self._node_idxs = {node: i for i, node in enumerate(self.nodes)}
+            return self.nodes, self._node_idxs, self.indptr, self.indices
+        nodes = list(self.adj_list.keys())
+        node_idxs = {node: i for i, node in enumerate(nodes)}
+        indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+        np.cumsum(self.degrees(), out=indptr[1:])
+        indices = np.fromiter((node_idxs[neighbor] for neighbors in self.adj_list.values() for neighbor in neighbors),
+                              dtype=np.int64, count=indptr[-1])
+        return nodes, node_idxs, indptr, indices
+
+    # sparse version of weighted_adj_matrix (same lazy walk, row i has 1/(deg+1) on i and on each neighbor).
+    # cached on frozen graphs so repeated analyses share one operator
+    def transition_operator(self) -> tuple[list[Node], dict[Node, int], sp.csr_matrix]:
+        if self._transition_operator is not None:
+            nodes, node_idxs, _, _ = self.csr_arrays()
+            return nodes, node_idxs, self._transition_operator
+        nodes, node_idxs, indptr, indices = self.csr_arrays()
+        n = len(nodes)
+        weights = 1 / (np.diff(indptr) + 1)
+        adjacency = sp.csr_matrix((np.repeat(weights, np.diff(indptr)), indices, indptr), shape=(n, n))
+        mat = (adjacency + sp.diags(weights)).tocsr()
+        if self.frozen:
+            self._transition_operator = mat
+        return nodes, node_idxs, mat
+
+    # transpose of transition_operator in CSR form, for pushing distributions forward one step at a time
+    def transposed_transition_operator(self) -> tuple[list[Node], dict[Node, int], sp.csr_matrix]:
+        nodes, node_idxs, mat = self.transition_operator()
+        if self._transposed_operator is not None:
+            return nodes, node_idxs, self._transposed_operator
+        mat_t = mat.T.tocsr()
+        if self.frozen:
+            self._transposed_operator = mat_t
+        return nodes, node_idxs, mat_t
+
+    # generator of the continuous time walk that RandomWalk simulates (rate 1 along every edge)
+    def generator(self) -> tuple[list[Node], dict[Node, int], sp.csr_matrix]:
+        nodes, node_idxs, indptr, indices = self.csr_arrays()
+        if self._generator is not None:
+            return nodes, node_idxs, self._generator
+        n = len(nodes)
+        adjacency = sp.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(n, n))
+        mat = (adjacency - sp.diags(np.diff(indptr).astype(np.float64))).tocsr()
+        if self.frozen:
+            self._generator = mat
+        return nodes, node_idxs, mat
+
     def markov_matrix_n_steps(self, n: int) -> tuple[list[Node], dict[Node, int], np.ndarray]:
         nodes, node_idxs, mat = self.weighted_adj_matrix()
         return nodes, node_idxs, np.linalg.matrix_power(mat, n)
     
+    # n sparse mat-vec products instead of a dense matrix power
     def distribution_n_steps(self, start: Node, n: int) -> tuple[list[Node], dict[Node, int], np.ndarray]:
-        nodes, node_idxs, mat = self.markov_matrix_n_steps(n)
-        initial_state = np.zeros((1, len(nodes)))
-        initial_state[node_idxs[start]] = 1
-        return initial_state @ mat
-    
-    def stationary_distribution(self) -> tuple[list[Node], dict[Node, int], np.ndarray]:
-        nodes, node_idxs, mat = self.weighted_adj_matrix()
-        S, U = np.linalg.eig(mat.T)
-        return nodes, node_idxs, (U[:,np.isclose(S, 1)][:,0] / U[:,np.isclose(S, 1)][:,0].sum()).real
+        nodes, node_idxs, mat_t = self.transposed_transition_operator()
+        state = np.zeros(len(nodes))
+        state[node_idxs[start]] = 1
+        for _ in range(n):
+            state = mat_t @ state
+        return nodes, node_idxs, state
     
+    def stationary_distribution(self, tol: float = 1e-12, max_iter: int = 10000) -> tuple[list[Node], dict[Node, int], np.ndarray]:
+        if not self.directed:
+            # the lazy walk is reversible with pi_i * P_ij = 1/Z on every edge, so pi is proportional to degree + 1
+            nodes, node_idxs, indptr, _ = self.csr_arrays()
+            weights = np.diff(indptr) + 1.
+            return nodes, node_idxs, weights / weights.sum()
+        nodes, node_idxs, mat_t = self.transposed_transition_operator()
+        state = np.full(len(nodes), 1 / len(nodes))
+        for _ in range(max_iter): # the walk is lazy, so power iteration can't oscillate
+            next_state = mat_t @ state
+            if np.abs(next_state - state).sum() < tol:
+                return nodes, node_idxs, next_state / next_state.sum()
+            state = next_state
+        # slow mixing, fall back to Arnoldi for the eigenvector of eigenvalue 1
+        _, vecs = spla.eigs(mat_t, k=1, which='LM', v0=state)
+        vec = np.abs(vecs[:, 0].real)
+        return nodes, node_idxs, vec / vec.sum()
+
     def describe_stationary_distribution(self) -> dict[str, float]:
-        nodes, _, mat = self.stationary_distribution()
-        types = {}
-        for i, node in enumerate(nodes):
-            prob = types.setdefault(node.type, 0)
-            types[node.type] = prob + mat[i]
-        return types
+        from attributes import node_attributes # attributes imports this module
+        attributes = node_attributes(self) # freezes the graph, so the CSR order is the node id order
+        _, _, mat = self.stationary_distribution()
+        return dict(zip(attributes.type_names, np.bincount(attributes.type, weights=mat, minlength=len(attributes.type_names)).tolist()))
+
+    # per-layer breakdown of describe_stationary_distribution, for the samplers that define self.layers
+    def describe_stationary_distribution_by_layer(self) -> list[dict[str, float]]:
+        from attributes import node_attributes # attributes imports this module
+        attributes = node_attributes(self)
+        _, _, mat = self.stationary_distribution()
+        type_names = attributes.type_names
+        layer_of = np.where(attributes.layer >= 0, attributes.layer, len(self.layers)) # nodes outside of any layer go in an overflow bucket
+        totals = np.bincount(layer_of * len(type_names) + attributes.type, weights=mat,
+                             minlength=(len(self.layers) + 1) * len(type_names)).reshape(-1, len(type_names))
+        return [{name: mass for name, mass in zip(type_names, row.tolist()) if mass > 0} for row in totals[:len(self.layers)]]
     
     def to_graphviz_layered(self, clusterings:list[tuple[str, list[int]]] = []) -> str:
-        output = 'graph G {\nrankdir="LR";\n'
-        layers_graphed = set()
+        output = io.StringIO()
+        self.write_graphviz_layered(output, clusterings)
+        return output.getvalue()
+
+    # writes the DOT document of to_graphviz_layered to file as it goes, one layer (or block of edges) per write.
+    # edges are deduplicated on integer ids, so every edge is written once, from its lower numbered end.
+    # layers, if given, restricts the document to those layer indices (an edge is kept when both ends are shown).
+    # collapse, if given, maps nodes to group keys (None for nodes that stay as they are): all the nodes of a group
+    # are drawn as a single node labelled with the group size, which makes large models small enough to render
+    def write_graphviz_layered(self, file: TextIO, clusterings:list[tuple[str, list[int]]] = [], layers: Iterable[int] = None,
+                               collapse: Callable[[Node], Hashable] = None):
+        if self.frozen: # node ids are the CSR indices, no need for the node_idxs dict
+            nodes, indptr, indices = self.nodes, self.indptr, self.indices
+            index_of = lambda node: node.id
+        else:
+            nodes, node_idxs, indptr, indices = self.csr_arrays()
+            index_of = node_idxs.__getitem__
+        n = len(nodes)
+        shown = set(range(len(self.layers))) if layers is None else set(layers) & set(range(len(self.layers)))
+        group = np.arange(n)
+        if collapse is not None:
+            keys: dict[Hashable, int] = {}
+            for i, node in enumerate(nodes):
+                key = collapse(node)
+                if key is not None:
+                    group[i] = n + keys.setdefault(key, len(keys))
+        group_size = np.bincount(group)
+        group_num = np.full(len(group_size), -1, dtype=np.int64)
+
         node_num = 0
+        def layer_lines(layer: list[Node], indent: str) -> list[str]:
+            nonlocal node_num
+            lines = []
+            for node in layer:
+                g = group[index_of(node)]
+                if group_num[g] < 0:
+                    group_num[g] = node_num
+                    label = f', label="{node.type} x{group_size[g]}"' if group_size[g] > 1 else ''
+                    lines.append(f'{indent}{node_num} [tooltip="{node.name}"{label}];\n')
+                    node_num += 1
+            return lines
+
+        file.write('graph G {\nrankdir="LR";\n')
+        layers_graphed = set()
         cluster_num = 0
         for cluster_name, cluster_layers in clusterings:
-            output += f'  subgraph cluster_{cluster_num} {{\nlabel="{cluster_name}";\n'
+            file.write(f'  subgraph cluster_{cluster_num} {{\nlabel="{cluster_name}";\n')
             cluster_num += 1
             for layer in cluster_layers:
                 layers_graphed.add(layer)
-                output += f'    subgraph cluster_{cluster_num} {{\n'
-                output += '    label="";\n'
+                if layer not in shown:
+                    continue
+                lines = [f'    subgraph cluster_{cluster_num} {{\n', '    label="";\n']
                 cluster_num += 1
-                for node in self.layers[layer]:
-                    node.in_graph_num = node_num
-                    output += f'      {node.in_graph_num} [tooltip="{node.name}"];\n'
-                    node_num += 1
-                output += '    }\n'
-            output += '  }\n'
+                lines += layer_lines(self.layers[layer], '      ')
+                lines.append('    }\n')
+                file.write(''.join(lines))
+            file.write('  }\n')
         for i, layer in enumerate(self.layers):
-            if i not in layers_graphed:
-                output += f'  subgraph cluster_{cluster_num} {{\n'
+            if i not in layers_graphed and i in shown:
+                lines = [f'  subgraph cluster_{cluster_num} {{\n']
                 cluster_num += 1
-                for node in layer:
-                    node.in_graph_num = node_num
-                    output += f'    {node.in_graph_num} [tooltip="{node.name}"];\n'
-                    node_num += 1
-                output += '  }\n'
-        for node, neighbors in self.adj_list.items():
-            for neighbor in neighbors:
-                if node.name < neighbor.name:
-                    output += f'  {node.in_graph_num} -- {neighbor.in_graph_num};\n'
-        output += '}\n'
-        return output
+                lines += layer_lines(layer, '    ')
+                lines.append('  }\n')
+                file.write(''.join(lines))
+
+        graph_num = group_num[group] # -1 for nodes that aren't shown
+        collapsed = []
+        block = 1 << 12
+        for first in range(0, n, block):
+            last = min(first + block, n)
+            sources = np.repeat(graph_num[first:last], np.diff(indptr[first:last + 1]))
+            targets = graph_num[indices[indptr[first]:indptr[last]]]
+            keep = (sources >= 0) & (sources < targets)
+            if collapse is not None:
+                collapsed.append(sources[keep] * (node_num + 1) + targets[keep])
+                continue
+            file.write(''.join([f'  {a} -- {b};\n' for a, b in zip(sources[keep].tolist(), targets[keep].tolist())]))
+        if collapse is not None:
+            # edges into a collapsed group repeat, so they are merged before writing
+            pairs = np.unique(np.concatenate(collapsed)) if collapsed else np.zeros(0, dtype=np.int64)
+            for first in range(0, len(pairs), block):
+                chunk = pairs[first:first + block]
+                file.write(''.join([f'  {a} -- {b};\n' for a, b in zip((chunk // (node_num + 1)).tolist(), (chunk % (node_num + 1)).tolist())]))
+        file.write('}\n')
+
+# Append-only buffers of nodes and edges that produce a graph's adjacency in one pass. Merging another graph or
+# builder costs O(its size); nodes shared between merged parts and edges added more than once are collapsed in build()
+class GraphBuilder:
+    def __init__(self, graph: Graph):
+        if graph.frozen:
+            raise Exception("cannot build into a frozen graph")
+        self.graph = graph
+        self.nodes: list[Node] = []
+        self.arcs: list[tuple[Node, Node]] = [] # undirected edges are stored in both directions
+        if graph.adj_list:
+            self.merge(graph)
+
+    def add_node(self, node_type: str, node_data: dict = None) -> Node:
+        node = self.graph.node_class(self.graph, node_type, node_data, name = str(len(self.nodes)))
+        self.nodes.append(node)
+        return node
+
+    def add_edge(self, node1: Node, node2: Node):
+        self.arcs.append((node1, node2))
+        if not self.graph.directed:
+            self.arcs.append((node2, node1))
+
+    def merge(self, other: 'Graph | GraphBuilder'):
+        if isinstance(other, GraphBuilder):
+            self.nodes.extend(other.nodes)
+            self.arcs.extend(other.arcs)
+            return
+        if self.graph.directed != other.directed:
+            raise Exception("cannot take the union of a directed and an undirected graph")
+        self.nodes.extend(other.adj_list)
+        self.arcs.extend((node, neighbor) for node, neighbors in other.adj_list.items() for neighbor in neighbors)
+
+    def build(self) -> Graph:
+        adj_list: dict[Node, list[Node]] = dict.fromkeys(self.nodes)
+        for node in adj_list:
+            adj_list[node] = []
+        for node1, node2 in self.arcs:
+            adj_list[node1].append(node2)
+        for node, neighbors in adj_list.items():
+            if len(neighbors) > 1:
+                adj_list[node] = list(dict.fromkeys(neighbors))
+        self.graph.adj_list = adj_list
+        return self.graph
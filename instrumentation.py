@@ -0,0 +1,153 @@
+from graph import Graph
+from randomwalk import RandomWalk
+from trajectory import TrajectoryStore
+from collections import Counter, defaultdict
+import contextlib
+import cProfile
+import io
+import pstats
+import sys
+import time
+import tracemalloc
+
+# Opt-in profiling of a simulate.py run: wall time per phase, counters and graph memory, plus optionally a cProfile
+# and a tracemalloc capture, all written to one report. Disabled instrumentation doesn't wrap anything, phase() is a
+# nullcontext and the walk's hot path (RandomWalk.step) is left untouched, so it costs nothing per step. Enabled, the
+# walk's step/run_for_time/observe are wrapped on the instance, the class itself is never modified.
+class Instrumentation:
+    def __init__(self, enabled: bool = False, cprofile: bool = False, memory: bool = False):
+        self.enabled = enabled
+        self.phases: dict[str, float] = defaultdict(float)
+        self.phase_calls: Counter = Counter()
+        self.counters: Counter = Counter()
+        self.graphs: dict[str, dict[str, float]] = {}
+        self.walks: list[RandomWalk] = []
+        self.profiler = cProfile.Profile() if enabled and cprofile else None
+        self.memory = enabled and memory
+        self.start_time = time.perf_counter()
+        if self.profiler is not None:
+            self.profiler.enable()
+        if self.memory:
+            tracemalloc.start()
+
+    # times the body of the with block under name (nested phases are counted in both)
+    def phase(self, name: str):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self.timed(name)
+
+    @contextlib.contextmanager
+    def timed(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+            self.phase_calls[name] += 1
+
+    def count(self, name: str, n: int = 1):
+        if self.enabled:
+            self.counters[name] += n
+
+    # turing machine runs of the store are timed as their own phase
+    def instrument_trajectories(self, trajectories: TrajectoryStore):
+        if not self.enabled:
+            return
+        get = trajectories.get
+        def timed_get(tm):
+            misses = trajectories.misses
+            with self.timed("turing machine"):
+                trajectory = get(tm)
+            self.count("trajectory cache misses" if trajectories.misses > misses else "trajectory cache hits")
+            return trajectory
+        trajectories.get = timed_get
+
+    # counts visits per node type (fast-forwarded hops too) and ready/not ready observations, and times walking and
+    # observing
+    def instrument_walk(self, walk: RandomWalk):
+        if not self.enabled:
+            return
+        self.walks.append(walk)
+        walk.segment_visits = Counter()
+        step, run_for_time, observe = walk.step, walk.run_for_time, walk.observe
+        visits = self.counters
+        def counting_step():
+            node = step()
+            visits["visits: " + walk.current_node.type] += 1
+            return node
+        def timed_run_for_time(time: float):
+            with self.timed("walk"):
+                run_for_time(time)
+        def counting_observe():
+            with self.timed("observe"):
+                ready, node = observe()
+            self.count("observations ready" if ready else "observations not ready")
+            return ready, node
+        walk.step, walk.run_for_time, walk.observe = counting_step, timed_run_for_time, counting_observe
+
+    # node and edge counts and an estimate of the memory held by the graph, from the CSR arrays and a sample of nodes
+    def account_graph(self, name: str, graph: Graph, sample_size: int = 1000):
+        if not self.enabled:
+            return
+        if not graph.frozen: # e.g. the implicit Monte Carlo model, which has no arrays to account for
+            self.graphs[name] = {"nodes": len(graph.adj_list)}
+            return
+        nodes = graph.nodes
+        step = max(1, len(nodes) // sample_size)
+        sample = nodes[::step]
+        node_bytes = sum(sys.getsizeof(node) + sys.getsizeof(node.data) for node in sample) / max(1, len(sample))
+        csr_bytes = graph.indptr.nbytes + graph.indices.nbytes
+        self.graphs[name] = {
+            "nodes": len(nodes),
+            "edges": len(graph.indices) if graph.directed else len(graph.indices) // 2,
+            "csr bytes": csr_bytes,
+            "node object bytes (estimate)": node_bytes * len(nodes),
+            "bytes per node (estimate)": node_bytes + csr_bytes / max(1, len(nodes)),
+        }
+
+    def report(self) -> str:
+        output = io.StringIO()
+        total = time.perf_counter() - self.start_time
+        print(f"total wall time: {total:.3f}s", file=output)
+        print("phases:", file=output)
+        for name, seconds in self.phases.items():
+            print(f"  {name:<28} {seconds:>10.3f}s  {self.phase_calls[name]:>10} calls", file=output)
+        counters = self.counters.copy()
+        counters["steps"] = sum(walk.steps for walk in self.walks)
+        for walk in self.walks:
+            for node_type, visits in walk.segment_visits.items():
+                counters["visits: " + node_type] += visits
+        if any(walk.segments is not None for walk in self.walks): # fast-forwarded walks move fewer times than they step
+            counters["fast-forward moves"] = sum(walk.moves for walk in self.walks if walk.segments is not None)
+        if "walk" in self.phases and self.phases["walk"] > 0:
+            counters["steps per second"] = round(counters["steps"] / self.phases["walk"])
+        print("counters:", file=output)
+        for name, value in sorted(counters.items()):
+            print(f"  {name:<28} {value:>12}", file=output)
+        for name, stats in self.graphs.items():
+            print(f"graph {name}:", file=output)
+            for stat, value in stats.items():
+                print(f"  {stat:<28} {value:>12.0f}", file=output)
+        if self.profiler is not None:
+            self.profiler.disable()
+            print("cProfile (top 30 by cumulative time):", file=output)
+            pstats.Stats(self.profiler, stream=output).sort_stats('cumulative').print_stats(30)
+        if self.memory:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"tracemalloc: current {current / 2**20:.2f}MB, peak {peak / 2**20:.2f}MB, top 20 lines:", file=output)
+            for stat in snapshot.statistics('lineno')[:20]:
+                print(f"  {stat}", file=output)
+        return output.getvalue()
+
+    # writes the report to path, or to stderr if path is None
+    def finish(self, path: str = None):
+        if not self.enabled:
+            return
+        report = self.report()
+        if path is None:
+            print(report, file=sys.stderr)
+        else:
+            with open(path, 'w') as file:
+                file.write(report)
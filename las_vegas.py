@@ -1,34 +1,38 @@
-from graph import Graph, Node
-from turing_machine import TuringMachine
-from common import Randomizer, HalfHourglass
+from graph import Graph, GraphBuilder, Node
+from turing_machine import TuringMachine, computation_lengths
+from common import Randomizer, HalfHourglass, TrajectoryStore, binary_string
+from trajectory import Trajectory, ComputationData
+from attributes import HALVES, node_attributes
 from typing import Callable
-from randomwalk import RandomWalk
-import random
+from collections.abc import Mapping, Sequence
+from randomwalk import RandomWalk, RandomStream, BatchRandomWalk
+import numpy as np
 
 def comp_length_to_output_length_converter(random_bits: int):
     converter: Callable[[int],int] = lambda comp_length: comp_length * 2 + random_bits + 1
     return converter
 class LasVegasSampler(Graph):
-    def __init__(self, random_bits: int, computation: TuringMachine):
+    def __init__(self, random_bits: int, computation: TuringMachine, trajectories: TrajectoryStore = None):
         super().__init__(directed = False)
+        trajectories = trajectories if trajectories is not None else TrajectoryStore()
 
-        randomizer = Randomizer(random_bits)
-        for node in randomizer.adj_list:
-            node.name = "rand_" + node.name
+        randomizer = Randomizer(random_bits, "rand_")
             
         comp_length_to_output_length = comp_length_to_output_length_converter(random_bits)
 
-        top_half = HalfHourglass(randomizer, computation, 'top', comp_length_to_output_length)
+        top_half = HalfHourglass(randomizer, computation, 'top', comp_length_to_output_length, trajectories)
         for node in top_half.adj_list:
             if node.type != 'randomizer':
                 node.name = "top_" + node.name
-        bottom_half = HalfHourglass(randomizer, computation, 'bottom', comp_length_to_output_length)
+        bottom_half = HalfHourglass(randomizer, computation, 'bottom', comp_length_to_output_length, trajectories)
         for node in bottom_half.adj_list:
             if node.type != 'randomizer':
                 node.name = "bottom_" + node.name
 
-        self.union(top_half)
-        self.union(bottom_half)
+        builder = GraphBuilder(self)
+        builder.merge(top_half)
+        builder.merge(bottom_half)
+        builder.build()
 
         top_layers = list(reversed([layer for layer in top_half.layers if layer[0].type != "randomizer"]))
         randomizer_layers = [layer for layer in bottom_half.layers if layer[0].type == "randomizer"]
@@ -37,14 +41,258 @@ class LasVegasSampler(Graph):
         self.bottom_layer_start_index = self.randomizer_layer_start_index + len(randomizer_layers)
         self.layers = top_layers + randomizer_layers + bottom_layers
 
+# a node of ImplicitLasVegasSampler, created on demand. its address is its layer (an index into the model's layers),
+# its random input as an int (for randomizer nodes, its index in the randomizer layer) and its track. it looks like
+# a LasVegasSampler node (name, type, data) and compares equal to any other state with the same address
+class LasVegasState:
+    __slots__ = ('model', 'layer', 'randomness', 'track')
+
+    def __init__(self, model: 'ImplicitLasVegasSampler', layer: int, randomness: int, track: int = 0):
+        self.model = model
+        self.layer = layer
+        self.randomness = randomness
+        self.track = track
+
+    @property
+    def address(self) -> tuple[int, int, int]:
+        return (self.layer, self.randomness, self.track)
+
+    @property
+    def type(self) -> str:
+        half, position = self.model.half_position(self.layer)
+        if half is None:
+            return "randomizer"
+        return "computation" if position < self.model.comp_lengths[self.randomness] else "output"
+
+    @property
+    def name(self) -> str:
+        half, position = self.model.half_position(self.layer)
+        if half is None:
+            return "rand_" + str(position * self.model.randomizer_layer_size + self.randomness)
+        return f"{half}_comp{binary_string(self.randomness, self.model.random_bits)}_track{self.track}_{position}"
+
+    @property
+    def data(self) -> dict:
+        half, position = self.model.half_position(self.layer)
+        if half is None:
+            return {'layer': position, 'bits': format(self.randomness, f'0{self.model.random_bits + 1}b')}
+        comp_length = int(self.model.comp_lengths[self.randomness])
+        extra = {"counter": position - comp_length} if position >= comp_length else {}
+        extra.update(half = half, randomness = binary_string(self.randomness, self.model.random_bits))
+        return ComputationData(self.model.trajectory(self.randomness), min(position, comp_length), extra)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, LasVegasState) and self.model is other.model and self.address == other.address
+
+    def __hash__(self) -> int:
+        return hash(self.address)
+
+    def __str__(self) -> str:
+        return self.name + " " + self.type + " " + str(self.data)
+
+# adj_list of ImplicitLasVegasSampler, neighbors are computed from the state's address in the same order as
+# LasVegasSampler stores them
+class HourglassAdjacency(Mapping):
+    def __init__(self, model: 'ImplicitLasVegasSampler'):
+        self.model = model
+
+    def __getitem__(self, state: LasVegasState) -> list[LasVegasState]:
+        if state not in self:
+            raise KeyError(state)
+        return self.model.neighbors(state)
+
+    def __contains__(self, state) -> bool:
+        if not isinstance(state, LasVegasState) or state.model is not self.model or not 0 <= state.layer < self.model.num_layers:
+            return False
+        half, position = self.model.half_position(state.layer)
+        if half is None:
+            return 0 <= state.randomness < self.model.randomizer_layer_size and state.track == 0
+        return 0 <= state.randomness < len(self.model.track_lengths) and state.track in (0, 1) \
+            and position < self.model.track_lengths[state.randomness]
+
+    def __iter__(self):
+        return iter(LasVegasNodes(self.model, 0))
+
+    def __len__(self) -> int:
+        return len(LasVegasNodes(self.model, 0))
+
+# the nodes of an ImplicitLasVegasSampler from index start on, in LasVegasSampler's node order: the randomizer layer
+# by layer, then per half and per random input the first track and then the second one
+class LasVegasNodes(Sequence):
+    def __init__(self, model: 'ImplicitLasVegasSampler', start: int):
+        self.model = model
+        self.start = start
+
+    def __len__(self) -> int:
+        return self.model.num_randomizer_layers * self.model.randomizer_layer_size + 2 * int(self.model.track_offsets[-1]) - self.start
+
+    def __getitem__(self, i: int) -> LasVegasState:
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.model.node_at(self.start + i)
+
+# LasVegasSampler without the graph: the hourglass is regular apart from the computations, so nodes are addresses
+# (see LasVegasState), neighbors are computed from the layer offsets and the track lengths, and node data is read
+# from the trajectory of the node's random input. memory is one computation length per input plus the trajectories
+# of the inputs the walk has reached, so it also runs for random bit counts whose LasVegasSampler doesn't fit in RAM
+class ImplicitLasVegasSampler(Graph):
+    def __init__(self, random_bits: int, computation: TuringMachine, trajectories: TrajectoryStore = None):
+        super().__init__(directed = False)
+        self.random_bits = random_bits
+        self.computation = computation
+        self.trajectories = trajectories if trajectories is not None else TrajectoryStore()
+        self.runs: dict[int, Trajectory] = {}
+
+        self.comp_lengths = computation_lengths(computation.rules, computation.state, random_bits)
+        self.track_lengths = self.comp_lengths + comp_length_to_output_length_converter(random_bits)(self.comp_lengths)
+        # index of the first node of the two tracks of every random input within a half
+        self.track_offsets = np.zeros(len(self.track_lengths) + 1, dtype=np.int64)
+        np.cumsum(2 * self.track_lengths, out=self.track_offsets[1:])
+
+        self.num_randomizer_layers = random_bits + 1
+        self.randomizer_layer_size = 2 ** self.num_randomizer_layers
+        half_length = int(self.track_lengths.max())
+        self.randomizer_layer_start_index = half_length
+        self.bottom_layer_start_index = half_length + self.num_randomizer_layers
+        self.num_layers = self.bottom_layer_start_index + half_length
+        self.adj_list = HourglassAdjacency(self)
+        # the nodes a LasVegasRandomWalk starts on
+        self.half_nodes = LasVegasNodes(self, self.num_randomizer_layers * self.randomizer_layer_size)
+
+    # the half ('top', 'bottom', or None for the randomizer) a layer is in, and the layer's position in it: the step of
+    # the computation for the halves (counted away from the randomizer) and the randomizer's own layer index
+    def half_position(self, layer: int) -> tuple[str, int]:
+        if layer < self.randomizer_layer_start_index:
+            return "top", self.randomizer_layer_start_index - 1 - layer
+        if layer >= self.bottom_layer_start_index:
+            return "bottom", layer - self.bottom_layer_start_index
+        return None, self.bottom_layer_start_index - 1 - layer
+
+    def layer_of(self, half: str, position: int) -> int:
+        if half == "top":
+            return self.randomizer_layer_start_index - 1 - position
+        if half == "bottom":
+            return self.bottom_layer_start_index + position
+        return self.bottom_layer_start_index - 1 - position
+
+    def trajectory(self, randomness: int) -> Trajectory:
+        if randomness not in self.runs:
+            random_tape = {i: c for i, c in enumerate(binary_string(randomness, self.random_bits))}
+            self.runs[randomness] = self.trajectories.get(TuringMachine(self.computation.rules, random_tape, self.computation.state))
+        return self.runs[randomness]
+
+    # the edges HalfHourglass builds: the randomizer's hypercube, the two randomizer nodes of every input joined to
+    # the first node of both tracks, and every track node joined along its track and to the neighbors of its
+    # position on the other track
+    def neighbors(self, state: LasVegasState) -> list[LasVegasState]:
+        half, position = self.half_position(state.layer)
+        k = state.randomness
+        if half is None:
+            neighbors = []
+            if position > 0:
+                flipped = k ^ (1 << (self.num_randomizer_layers - position))
+                layer = self.layer_of(None, position - 1)
+                neighbors += [LasVegasState(self, layer, k), LasVegasState(self, layer, flipped)]
+            if position < self.num_randomizer_layers - 1:
+                flipped = k ^ (1 << (self.num_randomizer_layers - position - 1))
+                layer = self.layer_of(None, position + 1)
+                neighbors += [LasVegasState(self, layer, min(k, flipped)), LasVegasState(self, layer, max(k, flipped))]
+            for attached_half, attached_position in (("top", self.num_randomizer_layers - 1), ("bottom", 0)):
+                if position == attached_position:
+                    layer = self.layer_of(attached_half, 0)
+                    neighbors += [LasVegasState(self, layer, k // 2, 0), LasVegasState(self, layer, k // 2, 1)]
+            return neighbors
+
+        last = self.track_lengths[k] - 1
+        previous_layer, next_layer = self.layer_of(half, position - 1), self.layer_of(half, position + 1)
+        neighbors = []
+        for track in (state.track, 1 - state.track):
+            if position > 0:
+                neighbors.append(LasVegasState(self, previous_layer, k, track))
+            if position < last:
+                neighbors.append(LasVegasState(self, next_layer, k, track))
+            if position == 0 and track == state.track:
+                layer = self.layer_of(None, self.num_randomizer_layers - 1 if half == "top" else 0)
+                neighbors += [LasVegasState(self, layer, 2 * k), LasVegasState(self, layer, 2 * k + 1)]
+        return neighbors
+
+    # node i in LasVegasSampler's node order, see LasVegasNodes
+    def node_at(self, i: int) -> LasVegasState:
+        randomizer_size = self.num_randomizer_layers * self.randomizer_layer_size
+        if i < randomizer_size:
+            return LasVegasState(self, self.layer_of(None, i // self.randomizer_layer_size), i % self.randomizer_layer_size)
+        half, i = divmod(i - randomizer_size, int(self.track_offsets[-1]))
+        k = int(np.searchsorted(self.track_offsets, i, side='right')) - 1
+        track, position = divmod(i - int(self.track_offsets[k]), int(self.track_lengths[k]))
+        return LasVegasState(self, self.layer_of(HALVES[half], position), k, track)
+
+    def freeze(self) -> Graph:
+        raise Exception("an implicit Las Vegas model has no CSR form, build a LasVegasSampler instead")
+
+    def random_node(self, generator: np.random.Generator) -> LasVegasState:
+        return self.node_at(int(generator.integers(len(self.adj_list))))
+
+    # materializes every state, only meant for small models (e.g. GraphViz output)
+    @property
+    def layers(self) -> list[list[LasVegasState]]:
+        layers = []
+        for layer in range(self.num_layers):
+            half, position = self.half_position(layer)
+            if half is None:
+                layers.append([LasVegasState(self, layer, index) for index in range(self.randomizer_layer_size)])
+            else:
+                layers.append([LasVegasState(self, layer, k, track) for k in np.flatnonzero(self.track_lengths > position).tolist()
+                               for track in (0, 1)])
+        return layers
+
 class LasVegasRandomWalk(RandomWalk):
     def __init__(self, model:LasVegasSampler, random_seed = None):
-        super().__init__(model, random.choice([node for node in model.adj_list if "half" in node.data]), random_seed)
+        stream = RandomStream(random_seed)
+        # the implicit model's half nodes are a computed sequence, in the order a LasVegasSampler stores them. a
+        # frozen model's are picked by id, so that only the start node is looked at
+        if isinstance(model, ImplicitLasVegasSampler):
+            start = stream.choice(model.half_nodes)
+        else:
+            model.freeze()
+            start = model.nodes[int(stream.choice(np.flatnonzero(half_codes(model)[0] >= 0)))]
+        super().__init__(model, start, stream)
         self.half = self.current_node.data["half"]
+        self.output_half = None
 
     def observe(self) -> tuple[bool, Node]:
+        if self.graph.frozen:
+            if self.output_half is None: # per-node codes, so that observations don't look at node data
+                self.output_half = memoryview(half_codes(self.graph)[1])
+            half = self.output_half[self.current_node.id]
+            ready = half >= 0 and HALVES[half] != self.half
+            if ready:
+                self.half = HALVES[half]
+            return ready, self.current_node
         ready = False
         if self.current_node.type == "output" and self.current_node.data["half"] != self.half:
             ready = True
             self.half = self.current_node.data["half"]
-        return ready, self.current_node
\ No newline at end of file
+        return ready, self.current_node
+
+# index into HALVES of every node of a frozen model (-1 for randomizer nodes), and the same restricted to output nodes
+def half_codes(model: LasVegasSampler) -> tuple[np.ndarray, np.ndarray]:
+    attributes = node_attributes(model)
+    output_half = np.where(attributes.type == attributes.type_code("output"), attributes.half, -1).astype(np.int8)
+    return attributes.half, output_half
+
+class BatchLasVegasRandomWalk(BatchRandomWalk):
+    def __init__(self, model:LasVegasSampler, num_walkers: int, random_seed = None):
+        node_half, self.output_half = half_codes(model)
+        rng = np.random.default_rng(random_seed)
+        super().__init__(model, rng.choice(np.flatnonzero(node_half >= 0), size=num_walkers), rng)
+        self.half = node_half[self.positions]
+
+    def observe(self) -> tuple[np.ndarray, np.ndarray]:
+        output_half = self.output_half[self.positions]
+        ready = (output_half >= 0) & (output_half != self.half)
+        self.half[ready] = output_half[ready]
+        return ready, self.positions.copy()
+
+# graphviz collapse key that merges the two tracks of every output-hold chain into one node
+def lv_output_chain_key(node: Node):
+    return (node.data["half"], node.data["randomness"]) if node.type == "output" else None
@@ -0,0 +1,99 @@
+from graph import Graph, Node
+from las_vegas import ImplicitLasVegasSampler
+from montecarlo import ImplicitMonteCarloSampler
+from randomwalk import RandomWalk
+from attributes import node_attributes
+from typing import Callable
+import numpy as np
+import scipy.sparse.linalg as spla
+
+# How fast the continuous time walk that RandomWalk simulates (rate 1 along every edge, generator Q = A - D) forgets
+# where it was, to choose the time between observations. The spectral gap (smallest nonzero eigenvalue of -Q) comes
+# from the sparse generator, the empirical estimate from the autocorrelation of a short walk, which also works on
+# models that are never materialized (the implicit ones). Q is symmetric on undirected graphs, so the walk is
+# reversible with a uniform stationary distribution and the gap bounds the total variation distance at every time.
+
+# smallest nonzero eigenvalue of -Q, by shift-invert Lanczos (Arnoldi for directed graphs). a connected graph has
+# gap >= 4 / (n * diameter) >= 4 / n^2 (Mohar), so with the shift at -1 / n^2 the two eigenvalues nearest to it
+# are 0 and the gap
+def spectral_gap(graph: Graph) -> float:
+    _, _, generator = graph.generator()
+    n = generator.shape[0]
+    if n < 2:
+        raise Exception("a walk on fewer than two nodes has no spectral gap")
+    laplacian = (-generator).tocsc()
+    shift = 1 / n**2
+    if n <= 64: # ARPACK needs more nodes than eigenvalues asked for, small graphs are solved dense
+        eigenvalues = np.sort(np.linalg.eigvals(laplacian.toarray()).real)[:2]
+    elif graph.directed:
+        eigenvalues = spla.eigs(laplacian, k=2, sigma=-shift, which='LM', v0=np.ones(n), return_eigenvectors=False).real
+    else:
+        eigenvalues = spla.eigsh(laplacian, k=2, sigma=-shift, which='LM', v0=np.ones(n) + np.arange(n) / n,
+                                 return_eigenvectors=False)
+    gap = float(np.max(eigenvalues))
+    if gap < shift:
+        raise Exception("the graph is not connected, so the walk doesn't mix and has no spectral gap")
+    return gap
+
+# smallest time t with d(t) <= tv, from d(t) <= 1/2 sqrt((1 - pi_min) / pi_min) exp(-t / relaxation_time), which
+# holds for reversible walks from any start (Levin, Peres & Wilmer, Theorem 20.6). pi_min is 1 / num_nodes here
+def tv_mixing_time(relaxation_time: float, num_nodes: int, tv: float) -> float:
+    if not 0 < tv < 1:
+        raise Exception("the total variation target has to be between 0 and 1")
+    return max(0., relaxation_time * (np.log(1 / (2 * tv)) + 0.5 * np.log(max(num_nodes - 1, 1))))
+
+# layer index of a node, the slowest coordinate of the samplers (mass moves between halves through the randomizer)
+def layer_observable(graph: Graph) -> Callable[[Node], float]:
+    if isinstance(graph, (ImplicitLasVegasSampler, ImplicitMonteCarloSampler)):
+        return lambda state: state.layer
+    layer_of = node_attributes(graph).layer
+    return lambda node: float(layer_of[node.id])
+
+# autocorrelation of observable along the walk, read every interval of time, samples times. returns the integrated
+# autocorrelation time interval * (1/2 + sum of the autocorrelations), which is the relaxation time of the slowest
+# mode for an exponential decay, and whether Sokal's window (5 integrated times) closed before the samples ran out.
+# when it didn't, the run was too short and the estimate is a lower bound
+def empirical_relaxation_time(walk: RandomWalk, interval: float, samples: int = 2000,
+                              observable: Callable[[Node], float] = None) -> tuple[float, bool]:
+    observable = observable or layer_observable(walk.graph)
+    values = np.zeros(samples)
+    for i in range(samples):
+        walk.run_for_time(interval)
+        values[i] = observable(walk.current_node)
+    values -= values.mean()
+    if not values.any():
+        raise Exception("the observable didn't change along the walk, nothing to estimate from")
+    spectrum = np.fft.rfft(values, 2 * samples)
+    autocorrelation = np.fft.irfft(spectrum * spectrum.conj(), 2 * samples)[:samples]
+    autocorrelation /= autocorrelation[0]
+    integrated = 0.5
+    for lag in range(1, samples):
+        integrated += autocorrelation[lag]
+        if lag >= 5 * integrated:
+            return float(interval * integrated), True
+    return float(interval * integrated), False
+
+# spectral gap and relaxation times of a model. the empirical estimate reads the walk every interval of time (a
+# fraction of the spectral relaxation time when there is one) and is only run to compare it with the spectral one,
+# for the implicit models, which have no spectral part, and when the spectral solve doesn't converge
+def analyze_mixing(model: Graph, walk: RandomWalk, interval: float, samples: int = 2000, compare: bool = False) -> dict:
+    analysis = {"nodes": len(model.adj_list)}
+    if not isinstance(model, (ImplicitLasVegasSampler, ImplicitMonteCarloSampler)):
+        try:
+            gap = spectral_gap(model)
+        except (spla.ArpackError, np.linalg.LinAlgError) as error:
+            analysis["spectral solve failed"] = str(error)
+        else:
+            analysis["spectral gap"] = gap
+            analysis["relaxation time (spectral)"] = 1 / gap
+            interval = analysis["relaxation time (spectral)"] / 20
+    if compare or "spectral gap" not in analysis:
+        analysis["relaxation time (empirical)"], analysis["empirical estimate converged"] = \
+            empirical_relaxation_time(walk, interval, samples)
+    return analysis
+
+# the relaxation time --auto-T uses: the spectral one when there is one, the empirical one otherwise
+def relaxation_time(analysis: dict) -> float:
+    if "relaxation time (spectral)" in analysis:
+        return analysis["relaxation time (spectral)"]
+    return analysis["relaxation time (empirical)"]
@@ -0,0 +1,280 @@
+from graph import Graph, Node, CSRAdjacency
+from turing_machine import Rules
+from collections.abc import Mapping, Sequence
+import numpy as np
+import hashlib
+import json
+import os
+import shutil
+
+# Compiled models saved as plain .npy arrays (CSR adjacency, node names, types, layers and node data columns) in one
+# directory per (rules, initial state, random bits, model kind). Later runs memory-map the arrays instead of rebuilding
+# the sampler, and node names and data are only decoded when they are looked at.
+
+MODEL_CACHE_FORMAT = 1
+# model attributes besides layers that are kept, when the model has them
+MODEL_ATTRIBUTES = ('randomizer_layer_start_index', 'bottom_layer_start_index')
+
+def model_key(rules: Rules, initial_state: str, random_bits: int, model_kind: str) -> str:
+    description = f"{MODEL_CACHE_FORMAT}\n{model_kind}\n{random_bits}\n{initial_state}\n{rules.fingerprint}"
+    return hashlib.sha256(description.encode()).hexdigest()
+
+# strings packed into one utf-8 buffer plus offsets, so that a column of them can be memory-mapped
+def pack_strings(strings: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    encoded = [string.encode() for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)), out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+def unpack_string(buffer: np.ndarray, offsets: np.ndarray, i: int) -> str:
+    return buffer[offsets[i]:offsets[i + 1]].tobytes().decode()
+
+# names, types and data of a list of nodes as arrays. every data key becomes a column of per-node codes (-1 where the
+# node doesn't have the key) into a table of the distinct values, or into references for values that are nodes
+def encode_nodes(nodes: list[Node], references: dict[Node, int] = None) -> tuple[dict, dict[str, np.ndarray]]:
+    arrays = {}
+    arrays['name.bytes'], arrays['name.offsets'] = pack_strings([node.name for node in nodes])
+    from attributes import node_types # attributes imports this module
+    type_names, arrays['type'] = node_types(nodes)
+    columns: dict[str, str] = {}
+    values: dict[str, dict] = {}
+    codes: dict[str, np.ndarray] = {}
+    for i, node in enumerate(nodes):
+        for key, value in (node.data or {}).items():
+            if key not in columns:
+                if isinstance(value, Node) and references is not None:
+                    columns[key] = 'node'
+                elif isinstance(value, str):
+                    columns[key] = 'str'
+                elif isinstance(value, int):
+                    columns[key] = 'int'
+                else:
+                    raise Exception(f"cannot cache node data '{key}' of type {type(value).__name__}")
+                values[key] = {}
+                codes[key] = np.full(len(nodes), -1, dtype=np.int32)
+            if columns[key] == 'node':
+                codes[key][i] = references[value]
+            else:
+                codes[key][i] = values[key].setdefault(value, len(values[key]))
+    for key, kind in columns.items():
+        arrays[f'data.{key}.codes'] = codes[key]
+        if kind == 'str':
+            arrays[f'data.{key}.bytes'], arrays[f'data.{key}.offsets'] = pack_strings(list(values[key]))
+        elif kind == 'int':
+            arrays[f'data.{key}.values'] = np.array(list(values[key]), dtype=np.int64)
+    return {'types': type_names, 'columns': columns}, arrays
+
+# encode_nodes of the nodes of a model (frozen first) and of the component nodes their data points at (the nodes of
+# the halves, for Monte Carlo models), and the component nodes in the order the references count them
+def encode_model(model: Graph) -> tuple[tuple[dict, dict], tuple[dict, dict], list[Node]]:
+    model.freeze()
+    components: dict[Node, int] = {}
+    for node in model.nodes:
+        for value in (node.data or {}).values():
+            if isinstance(value, Node):
+                components.setdefault(value, len(components))
+    return encode_nodes(model.nodes, components), encode_nodes(list(components)), list(components)
+
+# decoded view of the arrays written by encode_nodes. references are the nodes that 'node' columns point at
+class NodeTable:
+    def __init__(self, meta: dict, arrays: dict[str, np.ndarray], references: list[Node] = None):
+        self.types: list[str] = meta['types']
+        self.columns: dict[str, str] = meta['columns']
+        self.arrays = arrays
+        self.references = references
+
+    def __len__(self) -> int:
+        return len(self.arrays['type'])
+
+    def name(self, i: int) -> str:
+        return unpack_string(self.arrays['name.bytes'], self.arrays['name.offsets'], i)
+
+    def type(self, i: int) -> str:
+        return self.types[self.arrays['type'][i]]
+
+    def has(self, key: str, i: int) -> bool:
+        return key in self.columns and self.arrays[f'data.{key}.codes'][i] >= 0
+
+    def value(self, key: str, i: int):
+        if not self.has(key, i):
+            raise KeyError(key)
+        code = int(self.arrays[f'data.{key}.codes'][i])
+        match self.columns[key]:
+            case 'node':
+                return self.references[code]
+            case 'str':
+                return unpack_string(self.arrays[f'data.{key}.bytes'], self.arrays[f'data.{key}.offsets'], code)
+            case 'int':
+                return int(self.arrays[f'data.{key}.values'][code])
+
+class CachedNodeData(Mapping):
+    __slots__ = ('table', 'i')
+
+    def __init__(self, table: NodeTable, i: int):
+        self.table = table
+        self.i = i
+
+    def __getitem__(self, key):
+        return self.table.value(key, self.i)
+
+    def __contains__(self, key) -> bool:
+        return self.table.has(key, self.i)
+
+    def __iter__(self):
+        return (key for key in self.table.columns if self.table.has(key, self.i))
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+def cached_node(graph: 'CachedModel', table: str, i: int) -> Node:
+    return (graph.nodes if table == 'nodes' else graph.components)[i]
+
+# a node of a CachedModel, only its table and row are stored and everything else is read from the arrays
+class CachedNode(Node):
+    __slots__ = ('table',)
+
+    def __init__(self, graph: 'CachedModel', table: NodeTable, i: int):
+        self.graph = graph
+        self.table = table
+        self.id = i
+
+    name = property(lambda self: self.table.name(self.id))
+    type = property(lambda self: self.table.type(self.id))
+    data = property(lambda self: CachedNodeData(self.table, self.id))
+
+    # nodes unpickle to the node with the same row of the reloaded model, so they stay members of its adj_list
+    def __reduce__(self):
+        return cached_node, (self.graph, 'nodes' if self.table is self.graph.node_table else 'components', self.id)
+
+# the nodes of a CachedModel. each CachedNode is made the first time it is asked for, and is the same object after that
+class CachedNodes(Sequence):
+    def __init__(self, graph: 'CachedModel', table: NodeTable):
+        self.graph = graph
+        self.table = table
+        self.made: list[CachedNode] = [None] * len(table)
+
+    def __len__(self) -> int:
+        return len(self.made)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        node = self.made[i]
+        if node is None:
+            i %= len(self.made)
+            node = self.made[i] = CachedNode(self.graph, self.table, i)
+        return node
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+# the layers of a CachedModel as node ids (layer i is node_ids[offsets[i]:offsets[i + 1]]), each a list of nodes when read
+class CachedLayers(Sequence):
+    def __init__(self, nodes: CachedNodes, offsets: np.ndarray, node_ids: np.ndarray):
+        self.nodes = nodes
+        self.offsets = offsets
+        self.node_ids = node_ids
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = range(len(self))[i]
+        nodes = self.nodes
+        return [nodes[j] for j in self.node_ids[self.offsets[i]:self.offsets[i + 1]].tolist()]
+
+# a frozen model loaded from a model cache directory. it behaves like the frozen sampler it was saved from: same
+# node order, names, types, data, layers and attributes. Monte Carlo nodes point at component nodes of the halves.
+# loading reads no node: nodes and layers are made as they are looked at
+class CachedModel(Graph):
+    def __init__(self, path: str):
+        with open(os.path.join(path, 'meta.json')) as file:
+            meta = json.load(file)
+        if meta['format'] != MODEL_CACHE_FORMAT:
+            raise Exception(f"model cache format {meta['format']} is not supported")
+        super().__init__(meta['directed'])
+        self.path = path
+        self.model_kind: str = meta['model_kind']
+        arrays = {os.path.splitext(name)[0]: np.load(os.path.join(path, name), mmap_mode='r')
+                  for name in os.listdir(path) if name.endswith('.npy')}
+        table_arrays = lambda prefix: {name[len(prefix):]: array for name, array in arrays.items() if name.startswith(prefix)}
+
+        self.component_table = NodeTable(meta['components'], table_arrays('components.'))
+        self.components = CachedNodes(self, self.component_table)
+        self.node_table = NodeTable(meta['nodes'], table_arrays('nodes.'), self.components)
+        self.nodes = CachedNodes(self, self.node_table)
+
+        self.indptr, self.indices = arrays['indptr'], arrays['indices']
+        self.adj_list = CSRAdjacency(self.nodes, self.indptr, self.indices)
+        self.frozen = True
+        self.layers = CachedLayers(self.nodes, arrays['layer_offsets'], arrays['layer_nodes'])
+        for name, value in meta['attributes'].items():
+            setattr(self, name, value)
+
+    # workers reload the model from its directory instead of receiving a copy of the arrays
+    def __reduce__(self):
+        return CachedModel, (self.path,)
+
+class ModelCache:
+    # with cache_dir None nothing is loaded or saved
+    def __init__(self, cache_dir: str = None):
+        self.cache_dir = cache_dir
+
+    def path(self, rules: Rules, initial_state: str, random_bits: int, model_kind: str) -> str:
+        return os.path.join(self.cache_dir, model_key(rules, initial_state, random_bits, model_kind))
+
+    def load(self, rules: Rules, initial_state: str, random_bits: int, model_kind: str) -> CachedModel:
+        if self.cache_dir is None:
+            return None
+        path = self.path(rules, initial_state, random_bits, model_kind)
+        if not os.path.exists(os.path.join(path, 'meta.json')):
+            return None
+        return CachedModel(path)
+
+    # writes a frozen model and returns it. the directory is written under a temporary name and renamed once complete
+    def save(self, rules: Rules, initial_state: str, random_bits: int, model_kind: str, model: Graph) -> Graph:
+        if self.cache_dir is None:
+            return model
+        (node_meta, node_arrays), (component_meta, component_arrays), components = encode_model(model)
+        if model._node_attributes is None: # the walkers read the same columns, so they needn't be read from the nodes again
+            from attributes import NodeAttributes # attributes imports this module
+            model._node_attributes = NodeAttributes.from_tables(model, NodeTable(node_meta, node_arrays, components),
+                                                                NodeTable(component_meta, component_arrays))
+        node_idxs = {node: i for i, node in enumerate(model.nodes)}
+        arrays = {
+            'indptr': model.indptr,
+            'indices': model.indices,
+            'layer_offsets': np.cumsum([0] + [len(layer) for layer in model.layers], dtype=np.int64),
+            'layer_nodes': np.fromiter((node_idxs[node] for layer in model.layers for node in layer), dtype=np.int64,
+                                       count=sum(len(layer) for layer in model.layers)),
+            **{'nodes.' + name: array for name, array in node_arrays.items()},
+            **{'components.' + name: array for name, array in component_arrays.items()},
+        }
+        meta = {
+            'format': MODEL_CACHE_FORMAT,
+            'model_kind': model_kind,
+            'directed': model.directed,
+            'nodes': node_meta,
+            'components': component_meta,
+            'attributes': {name: getattr(model, name) for name in MODEL_ATTRIBUTES if hasattr(model, name)},
+        }
+
+        path = self.path(rules, initial_state, random_bits, model_kind)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        shutil.rmtree(temporary, ignore_errors=True)
+        os.makedirs(temporary)
+        for name, array in arrays.items():
+            np.save(os.path.join(temporary, name + '.npy'), array)
+        with open(os.path.join(temporary, 'meta.json'), 'w') as file:
+            json.dump(meta, file)
+        try:
+            os.replace(temporary, path)
+        except OSError: # another run saved the same model first
+            shutil.rmtree(temporary, ignore_errors=True)
+        return model
@@ -1,71 +1,232 @@
 from graph import *
 from common import *
-from randomwalk import RandomWalk
+from randomwalk import RandomWalk, RandomStream, BatchRandomWalk
 from turing_machine import *
 from itertools import product
-import random
+from collections.abc import Mapping
+from attributes import HALVES, node_attributes
+import numpy as np
+import time
 
 def comp_length_to_output_length_converter(random_bits: int):
     converter: Callable[[int],int] = lambda comp_length: comp_length + random_bits + 1
     return converter
 
+# a product node only stores its two components, its name, type and data ({"top", "bottom"}) are computed when
+# looked at, so the quadratic number of product nodes don't each hold a dict and two concatenated strings
+class MonteCarloNode(Node):
+    __slots__ = ('top_component', 'bottom_component')
+
+    def __init__(self, graph: 'Graph', node_type: str = None, data: dict = None, name: str = None):
+        self.graph = graph
+        self.top_component = data["top"]
+        self.bottom_component = data["bottom"]
+        self.id = -1
+
+    type = property(lambda self: self.top_component.type + "_" + self.bottom_component.type)
+    name = property(lambda self: self.top_component.name + "_" + self.bottom_component.name)
+    data = property(lambda self: {"top": self.top_component, "bottom": self.bottom_component})
+
+    # the computed attributes shadow Node's slots, so only the stored ones are pickled
+    def __getstate__(self) -> tuple:
+        return self.graph, self.id, self.top_component, self.bottom_component
+
+    def __setstate__(self, state: tuple):
+        self.graph, self.id, self.top_component, self.bottom_component = state
+
+# the top and bottom HalfHourglass of a Monte Carlo model, with the bottom layers reversed so that
+# product layer i pairs top_layers[i] with bottom_layers[i]
+def monte_carlo_halves(random_bits: int, computation: TuringMachine, trajectories: TrajectoryStore = None) \
+        -> tuple[HalfHourglass, HalfHourglass, list[list[Node]], list[list[Node]]]:
+    trajectories = trajectories if trajectories is not None else TrajectoryStore()
+    top_randomizer = Randomizer(random_bits, "rand_")
+    bottom_randomizer = Randomizer(random_bits, "rand_")
+    
+    comp_length_to_output_length = comp_length_to_output_length_converter(random_bits)
+
+    top_half = HalfHourglass(top_randomizer, computation, None, comp_length_to_output_length, trajectories)
+    for node in top_half.adj_list:
+        node.name = "top_" + node.name
+    bottom_half = HalfHourglass(bottom_randomizer, computation, None, comp_length_to_output_length, trajectories)
+    for node in bottom_half.adj_list:
+        node.name = "bottom_" + node.name
+
+    return top_half, bottom_half, top_half.layers, list(reversed(bottom_half.layers))
+
+# for every node of a half, its neighbors in the previous and in the next layer, each in layer order
+def layer_neighbors(layers: list[list[Node]], adj_list: dict[Node, list[Node]]) -> dict[Node, tuple[list[Node], list[Node]]]:
+    position = {node: (i, j) for i, layer in enumerate(layers) for j, node in enumerate(layer)}
+    neighbors = {}
+    for node, (i, _) in position.items():
+        adjacent = sorted(position[neighbor] for neighbor in adj_list[node] if neighbor in position)
+        neighbors[node] = ([layers[k][j] for k, j in adjacent if k == i - 1], [layers[k][j] for k, j in adjacent if k == i + 1])
+    return neighbors
+
 class MonteCarloSampler(Graph):
-    def __init__(self, random_bits: int, computation: TuringMachine):
+    node_class = MonteCarloNode
+
+    # progress, if given, is called with (layers built, total layers) after every layer
+    def __init__(self, random_bits: int, computation: TuringMachine, progress: Callable[[int, int], None] = None,
+                 trajectories: TrajectoryStore = None):
         super().__init__(directed = False)
+        start_time = time.perf_counter()
         
-        top_randomizer = Randomizer(random_bits)
-        for node in top_randomizer.adj_list:
-            node.name = "rand_" + node.name
-            
-        bottom_randomizer = Randomizer(random_bits)
-        for node in bottom_randomizer.adj_list:
-            node.name = "rand_" + node.name
-        
-        comp_length_to_output_length = comp_length_to_output_length_converter(random_bits)
-
-        top_half = HalfHourglass(top_randomizer, computation, None, comp_length_to_output_length)
-        for node in top_half.adj_list:
-            node.name = "top_" + node.name
-        bottom_half = HalfHourglass(bottom_randomizer, computation, None, comp_length_to_output_length)
-        for node in bottom_half.adj_list:
-            node.name = "bottom_" + node.name
-
-        top_layers = top_half.layers
-        bottom_layers = list(reversed(bottom_half.layers))
+        top_half, bottom_half, top_layers, bottom_layers = monte_carlo_halves(random_bits, computation, trajectories)
+        top_neighbors = layer_neighbors(top_layers, top_half.adj_list)
+        bottom_neighbors = layer_neighbors(bottom_layers, bottom_half.adj_list)
 
         self.layers: list[list[Node]] = [[] for _ in top_layers] # the pattern [[]] * len(top_layers) doesn't work here. try it in REPL to see why
+        previous_index: dict[tuple[Node, Node], Node] = {}
+        builder = GraphBuilder(self)
         
         for i, layer in enumerate(self.layers):
+            index: dict[tuple[Node, Node], Node] = {}
             for top_node, bottom_node in product(top_layers[i], bottom_layers[i]):
-                node = self.add_node(top_node.type + "_" + bottom_node.type, {"top": top_node, "bottom": bottom_node})
-                node.top_component = top_node
-                node.bottom_component = bottom_node
-                node.name = top_node.name + "_" + bottom_node.name
+                node = builder.add_node(None, {"top": top_node, "bottom": bottom_node})
                 layer.append(node)
+                index[(top_node, bottom_node)] = node
                 if i == 0: continue
-                top_neighbors = set(top_half.adj_list[top_node])
-                bottom_neighbors = set(bottom_half.adj_list[bottom_node])
-                
-                for potential_neighbor in self.layers[i - 1]:
-                    if potential_neighbor.top_component in top_neighbors and potential_neighbor.bottom_component in bottom_neighbors:
-                        self.add_edge(potential_neighbor, node)
+                # neighbor lists are in layer order, so edges come out in the same order as scanning the previous layer
+                for pair in product(top_neighbors[top_node][0], bottom_neighbors[bottom_node][0]):
+                    builder.add_edge(previous_index[pair], node)
+            previous_index = index
+            if progress is not None:
+                progress(i + 1, len(self.layers))
+        builder.build()
+        self.construction_time = time.perf_counter() - start_time
+
+# a node of ImplicitMonteCarloSampler, created on demand. it looks like a MonteCarloSampler node
+# (type, data["top"], data["bottom"], name) and compares equal to any other state with the same pair
+class MonteCarloState:
+    __slots__ = ('top_component', 'bottom_component', 'layer')
+
+    def __init__(self, top_component: Node, bottom_component: Node, layer: int):
+        self.top_component = top_component
+        self.bottom_component = bottom_component
+        self.layer = layer
+
+    @property
+    def type(self) -> str:
+        return self.top_component.type + "_" + self.bottom_component.type
+
+    @property
+    def data(self) -> dict:
+        return {"top": self.top_component, "bottom": self.bottom_component}
+
+    @property
+    def name(self) -> str:
+        return self.top_component.name + "_" + self.bottom_component.name
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, MonteCarloState) and self.top_component is other.top_component \
+            and self.bottom_component is other.bottom_component
+
+    def __hash__(self) -> int:
+        return hash((self.top_component, self.bottom_component))
+
+    def __str__(self) -> str:
+        return self.name + " " + self.type + " " + str(self.data)
+
+# adj_list of ImplicitMonteCarloSampler: neighbors of a (top, bottom) pair are the pairs of their neighbors in
+# the same adjacent product layer, which is the edge rule MonteCarloSampler materializes
+class ProductAdjacency(Mapping):
+    def __init__(self, model: 'ImplicitMonteCarloSampler'):
+        self.model = model
 
+    def __getitem__(self, state: MonteCarloState) -> list[MonteCarloState]:
+        top_prev, top_next = self.model.top_neighbors[state.top_component]
+        bottom_prev, bottom_next = self.model.bottom_neighbors[state.bottom_component]
+        return [MonteCarloState(top, bottom, state.layer - 1) for top, bottom in product(top_prev, bottom_prev)] + \
+               [MonteCarloState(top, bottom, state.layer + 1) for top, bottom in product(top_next, bottom_next)]
+
+    def __contains__(self, state) -> bool:
+        return isinstance(state, MonteCarloState) \
+            and self.model.top_layer_of.get(state.top_component) == state.layer \
+            and self.model.bottom_layer_of.get(state.bottom_component) == state.layer
+
+    def __iter__(self):
+        for i, (top_layer, bottom_layer) in enumerate(zip(self.model.top_layers, self.model.bottom_layers)):
+            for top, bottom in product(top_layer, bottom_layer):
+                yield MonteCarloState(top, bottom, i)
+
+    def __len__(self) -> int:
+        return int(self.model.layer_sizes.sum())
+
+# MonteCarloSampler without the product graph: only the two halves are kept, so memory is linear instead of
+# quadratic in the layer widths, and walker states are (top node, bottom node) pairs built as the walk moves
+class ImplicitMonteCarloSampler(Graph):
+    def __init__(self, random_bits: int, computation: TuringMachine, trajectories: TrajectoryStore = None):
+        super().__init__(directed = False)
+        top_half, bottom_half, self.top_layers, self.bottom_layers = monte_carlo_halves(random_bits, computation, trajectories)
+        self.top_neighbors = layer_neighbors(self.top_layers, top_half.adj_list)
+        self.bottom_neighbors = layer_neighbors(self.bottom_layers, bottom_half.adj_list)
+        self.top_layer_of = {node: i for i, layer in enumerate(self.top_layers) for node in layer}
+        self.bottom_layer_of = {node: i for i, layer in enumerate(self.bottom_layers) for node in layer}
+        self.layer_sizes = np.array([len(top_layer) * len(bottom_layer)
+                                     for top_layer, bottom_layer in zip(self.top_layers, self.bottom_layers)], dtype=np.int64)
+        self.adj_list = ProductAdjacency(self)
+
+    def freeze(self) -> Graph:
+        raise Exception("an implicit Monte Carlo model has no CSR form, build a MonteCarloSampler instead")
+
+    def random_node(self, generator: np.random.Generator) -> MonteCarloState:
+        i = int(generator.choice(len(self.layer_sizes), p=self.layer_sizes / self.layer_sizes.sum()))
+        return MonteCarloState(self.top_layers[i][generator.integers(len(self.top_layers[i]))],
+                               self.bottom_layers[i][generator.integers(len(self.bottom_layers[i]))], i)
+
+    # materializes every state, only meant for small models (e.g. GraphViz output)
+    @property
+    def layers(self) -> list[list[MonteCarloState]]:
+        return [[MonteCarloState(top, bottom, i) for top, bottom in product(top_layer, bottom_layer)]
+                for i, (top_layer, bottom_layer) in enumerate(zip(self.top_layers, self.bottom_layers))]
+# reset is whether both halves count as reset at the start (so that the first observation is independent), plot
+# trials start with neither
 class MonteCarloRandomWalk(RandomWalk):
-    def __init__(self, monte_carlo:MonteCarloSampler, random_seed = None):
-        super().__init__(monte_carlo, random.choice(list(monte_carlo.adj_list)), random_seed)
-        self.top_reset = self.bottom_reset = True
+    def __init__(self, monte_carlo:MonteCarloSampler, random_seed = None, reset: bool = True):
+        stream = RandomStream(random_seed)
+        super().__init__(monte_carlo, monte_carlo.random_node(stream.generator), stream)
+        self.top_reset = self.bottom_reset = reset
+        self.reset_nodes = None
+        self.output_half = None
 
     def step(self):
         super().step()
-        top_node = self.current_node.data["top"]
-        bottom_node = self.current_node.data["bottom"]
-        if top_node.type == "randomizer" and top_node.data["layer"] == 0:
+        self.visited()
+
+    def visited(self):
+        if self.graph.frozen:
+            if self.reset_nodes is None: # per-node flags, so that steps don't look at node data (slow on cached models)
+                self.reset_nodes = tuple(memoryview(mask) for mask in reset_masks(self.graph))
+            top_reset_node, bottom_reset_node = self.reset_nodes
+            if top_reset_node[self.current_node.id]:
+                self.top_reset = True
+            elif bottom_reset_node[self.current_node.id]:
+                self.bottom_reset = True
+            return
+        if is_reset_component(self.current_node.data["top"]):
             self.top_reset = True
-        elif bottom_node.type == "randomizer" and bottom_node.data["layer"] == 0:
+        elif is_reset_component(self.current_node.data["bottom"]):
             self.bottom_reset = True
+
+    # after an unbounded time both halves have been reset
+    def jump_to(self, node: Node):
+        super().jump_to(node)
+        self.top_reset = self.bottom_reset = True
+
+    def pinned_nodes(self) -> set[int]:
+        top_reset_node, bottom_reset_node = reset_masks(self.graph)
+        return set(np.flatnonzero(top_reset_node | bottom_reset_node).tolist())
         
     def observe(self) -> tuple[bool, Node]:
-        outputting_half, _ = outputting_half_of_monte_carlo_node(self.current_node)
+        if self.graph.frozen:
+            if self.output_half is None: # per-node codes, like the reset flags in visited()
+                self.output_half = memoryview(output_half_codes(self.graph))
+            code = self.output_half[self.current_node.id]
+            if code < 0:
+                raise Exception("Monte Carlo node in invalid top/bottom state")
+            outputting_half = HALVES[code]
+        else:
+            outputting_half, _ = outputting_half_of_monte_carlo_node(self.current_node)
         outputting_half_was_reset = None
         if outputting_half == "top":
             outputting_half_was_reset = self.top_reset
@@ -75,6 +236,55 @@ class MonteCarloRandomWalk(RandomWalk):
             self.bottom_reset = False
         return outputting_half_was_reset, self.current_node
 
+class BatchMonteCarloRandomWalk(BatchRandomWalk):
+    def __init__(self, monte_carlo:MonteCarloSampler, num_walkers: int, random_seed = None, reset: bool = True):
+        monte_carlo.freeze()
+        rng = np.random.default_rng(random_seed)
+        super().__init__(monte_carlo, rng.integers(len(monte_carlo.nodes), size=num_walkers), rng)
+        self.top_reset_node, self.bottom_reset_node = reset_masks(monte_carlo)
+        self.output_half = output_half_codes(monte_carlo)
+        self.top_reset = np.full(num_walkers, reset)
+        self.bottom_reset = np.full(num_walkers, reset)
+
+    def visited(self, walkers: np.ndarray, positions: np.ndarray):
+        self.top_reset[walkers[self.top_reset_node[positions]]] = True
+        self.bottom_reset[walkers[self.bottom_reset_node[positions]]] = True
+
+    def observe(self) -> tuple[np.ndarray, np.ndarray]:
+        output_half = self.output_half[self.positions]
+        if (output_half < 0).any():
+            raise Exception("Monte Carlo node in invalid top/bottom state")
+        top = output_half == 0
+        was_reset = np.where(top, self.top_reset, self.bottom_reset)
+        self.top_reset[top] = False
+        self.bottom_reset[~top] = False
+        return was_reset, self.positions.copy()
+
+def is_reset_component(component: Node) -> bool:
+    return component.type == "randomizer" and component.data["layer"] == 0
+
+# for every node of a frozen model, whether stepping onto it resets the top (resp. bottom) half,
+# with the top half taking precedence like in MonteCarloRandomWalk.visited
+def reset_masks(monte_carlo: MonteCarloSampler) -> tuple[np.ndarray, np.ndarray]:
+    attributes = node_attributes(monte_carlo)
+    components = attributes.components
+    reset_component = (components.type == components.type_code("randomizer")) & (components.randomizer_layer == 0)
+    top_reset_node, bottom_reset_node = reset_component[attributes.top], reset_component[attributes.bottom]
+    return top_reset_node, bottom_reset_node & ~top_reset_node
+
+# outputting half of every node of a frozen model: 0 for top, 1 for bottom, -1 for an invalid top/bottom state
+# (see outputting_half_of_monte_carlo_node)
+def output_half_codes(monte_carlo: MonteCarloSampler) -> np.ndarray:
+    attributes = node_attributes(monte_carlo)
+    components = attributes.components
+    output_component = components.type == components.type_code("output")
+    other_component = (components.type == components.type_code("randomizer")) | (components.type == components.type_code("computation"))
+    top, bottom = attributes.top, attributes.bottom
+    codes = np.full(len(attributes), -1, dtype=np.int8)
+    codes[other_component[top] & output_component[bottom]] = HALVES.index("bottom")
+    codes[output_component[top] & other_component[bottom]] = HALVES.index("top")
+    return codes
+
 def outputting_half_of_monte_carlo_node(node: Node) -> tuple[str, Node]:
     top_type = node.data["top"].type
     bottom_type = node.data["bottom"].type
@@ -86,3 +296,15 @@ def outputting_half_of_monte_carlo_node(node: Node) -> tuple[str, Node]:
         case _:
             raise Exception("Monte Carlo node in invalid top/bottom state")
         
+
+# graphviz collapse key: a product node belongs to the output-hold chain of its outputting half, and the nodes pairing
+# one such chain with one computation (or with one randomizer node) of the other half are merged into one node. nodes
+# where both halves or neither are outputting (machines whose computations differ in length have them) stay as they are
+def mc_output_chain_key(node: Node):
+    if (node.data["top"].type == "output") == (node.data["bottom"].type == "output"):
+        return None
+    half, output = outputting_half_of_monte_carlo_node(node)
+    other = node.data["bottom" if half == "top" else "top"]
+    if other.type == "computation":
+        return (half, output.data["randomness"], other.data["randomness"])
+    return (half, output.data["randomness"], other.name)
@@ -1,77 +1,152 @@
 from las_vegas import *
 from montecarlo import *
 from randomwalk import *
+from chains import ChainSegments
 from turing_machine import *
+from transient import lv_output_ready_probs, mc_output_ready_probs
 from plotnine import *
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from statistics import NormalDist
 import pandas as pd
 import numpy as np
 
-def lv_create_plot_output_ready_prob(walk: RandomWalk, sampling_period: int):
-    max_trials = 20
+# the batched walker of each walker class, that plot trials run on
+BATCH_WALKS = {LasVegasRandomWalk: BatchLasVegasRandomWalk, MonteCarloRandomWalk: BatchMonteCarloRandomWalk}
 
-    output_probs = np.zeros(max_trials)
-    TRIALS = 500
-    
-    for i in range(TRIALS):
-        found = False
-        for j in range (max_trials):
-            if found:
-                output_probs[j] += 1.
-            else:
-                walk.run_for_time(sampling_period)
+# number of trials that saw a ready observation by each of the measurements, taken period time apart. every trial is
+# a fresh walker of walk_class (made with walk_options) and they all walk together in one batch, each until its first
+# ready observation. fast-forwarded walkers (crossing segments, see RandomWalk.enable_fast_forward) and models that can't be frozen
+# (the implicit ones) run their trials one walker after another instead
+def run_trials(model: Graph, walk_class: type, random_seed, trials: int, period: float, measurements: int,
+               segments: ChainSegments = None, walk_options: dict = {}) -> np.ndarray:
+    counts = np.zeros(measurements)
+    if segments is not None or isinstance(model, (ImplicitLasVegasSampler, ImplicitMonteCarloSampler)):
+        for seed in spawn_seeds(random_seed, trials):
+            walk = walk_class(model, seed, **walk_options)
+            if segments is not None:
+                walk.enable_fast_forward(segments)
+            for j in range(measurements):
+                walk.run_for_time(period)
                 ready, _ = walk.observe()
                 if ready:
-                    found = True
-                    output_probs[j] += 1.
+                    counts[j:] += 1.
+                    break
+        return counts
+    batch = BATCH_WALKS[walk_class](model, trials, random_seed, **walk_options)
+    active = np.arange(trials)
+    for j in range(measurements):
+        batch.run_for_time(period, active)
+        ready, _ = batch.observe()
+        counts[j:] += np.count_nonzero(ready[active])
+        active = active[~ready[active]]
+    return counts
 
-    for i in range(max_trials):
-        output_probs[i]/=float(TRIALS)
+# the segments that fast-forwarded trials of walk_class cross, built once and shared by all of them
+def fast_forward_segments(model: Graph, walk_class: type) -> ChainSegments:
+    walk = walk_class(model)
+    walk.enable_fast_forward()
+    return walk.segments
 
-    df = pd.DataFrame({
-        "sample_sizes": np.arange(1,21),
-        "output_probs": output_probs
-    })
+worker_model: Graph = None
+worker_segments: ChainSegments = None
+
+def init_worker(model: Graph, walk_class: type, fast_forward: bool):
+    global worker_model, worker_segments
+    worker_model = model
+    worker_segments = fast_forward_segments(model, walk_class) if fast_forward else None
+
+def run_trials_in_worker(walk_class: type, random_seed, trials: int, period: float, measurements: int,
+                         walk_options: dict) -> tuple[int, np.ndarray]:
+    return trials, run_trials(worker_model, walk_class, random_seed, trials, period, measurements, worker_segments, walk_options)
 
-    plt = ggplot(df, aes(x = "sample_sizes", y = "output_probs")) + \
+# trials per chunk, the same for any number of workers so that a seed gives the same curve on any of them
+TRIALS_PER_CHUNK = 100
+
+# fraction of trials with a ready observation by each measurement. trials are split into chunks, each with its own
+# seed spawned from random_seed, that run on a process pool with more than one worker and one after another in this
+# process otherwise, and the counts are merged as chunks finish
+def simulate_output_ready_probs(walk: RandomWalk, trials: int, period: float, measurements: int, workers: int = 1,
+                                fast_forward: bool = False, walk_options: dict = {}, random_seed = None) -> np.ndarray:
+    chunks = [min(TRIALS_PER_CHUNK, trials - start) for start in range(0, trials, TRIALS_PER_CHUNK)]
+    tasks = [(type(walk), seed, chunk, period, measurements, walk_options) for seed, chunk in zip(spawn_seeds(random_seed, len(chunks)), chunks)]
+    counts = np.zeros(measurements)
+    done = 0
+    def merge(chunk_trials: int, chunk_counts: np.ndarray):
+        nonlocal counts, done
+        counts += chunk_counts
+        done += chunk_trials
+        print(f"\r{done}/{trials} trials", end = '', flush=True)
+    if workers <= 1:
+        init_worker(walk.graph, type(walk), fast_forward)
+        for task in tasks:
+            merge(*run_trials_in_worker(*task))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(walk.graph, type(walk), fast_forward)) as pool:
+            for future in as_completed([pool.submit(run_trials_in_worker, *task) for task in tasks]):
+                merge(*future.result())
+    print()
+    return counts / trials
+
+# Wilson score interval for each estimated probability
+def confidence_band(probs: np.ndarray, trials: int, confidence: float) -> tuple[np.ndarray, np.ndarray]:
+    z = NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+    center = (probs + z**2 / (2 * trials)) / (1 + z**2 / trials)
+    half_width = z / (1 + z**2 / trials) * np.sqrt(probs * (1 - probs) / trials + z**2 / (4 * trials**2))
+    return np.clip(center - half_width, 0, 1), np.clip(center + half_width, 0, 1)
+
+def save_plot(df: pd.DataFrame, x: str, title: str, x_label: str, y_label: str, exact: bool, trials: int, confidence: float):
+    plt = ggplot(df, aes(x = x, y = "output_probs"))
+    if not exact:
+        df["lower"], df["upper"] = confidence_band(df["output_probs"].to_numpy(), trials, confidence)
+        plt = plt + geom_ribbon(aes(ymin = "lower", ymax = "upper"), fill = "red", alpha = 0.2)
+    source = "exact" if exact else f"{trials} trials, {confidence:.0%} CI"
+    plt = plt + \
         geom_point() + \
         geom_line(aes(group = 1), color = "red") + \
-        labs(title = f"Las Vegas Model - Simulated Probability of Observing a Valid Output\n by the Nth Measurement",
-             x = f"Number of Measurements T Time Apart", y = f"Probability of Seeing Valid Output ({TRIALS} trials)")
+        labs(title = title, x = x_label, y = f"{y_label} ({source})")
     plt.save("plot.png")
+    df.to_csv("plot.csv", index = False)
 
-def mc_create_plot_output_ready_prob(walk: RandomWalk, sampling_period: int):
-    max_time = sampling_period * 2
+def lv_create_plot_output_ready_prob(walk: RandomWalk, sampling_period: int, trials: int = 500, exact: bool = False,
+                                     workers: int = 1, confidence: float = 0.95, fast_forward: bool = False,
+                                     random_seed = None):
+    max_trials = 20
 
-    TIME_INCREMENT = 50
-    num_increments = int(max_time / TIME_INCREMENT)
-    print(num_increments, "increments")
+    if exact:
+        output_probs = lv_output_ready_probs(walk.graph, sampling_period, max_trials)
+    else:
+        output_probs = simulate_output_ready_probs(walk, trials, sampling_period, max_trials, workers, fast_forward,
+                                                   random_seed=random_seed)
 
-    output_probs = np.zeros(num_increments)
-    TRIALS = 500
+    df = pd.DataFrame({
+        "sample_sizes": np.arange(1, max_trials + 1),
+        "output_probs": output_probs
+    })
+    save_plot(df, "sample_sizes",
+              f"Las Vegas Model - Simulated Probability of Observing a Valid Output\n by the Nth Measurement",
+              f"Number of Measurements T Time Apart", f"Probability of Seeing Valid Output", exact, trials, confidence)
 
-    for i in range(TRIALS):
-        found = False
-        for j in range(num_increments):
-            if found:
-                output_probs[j] += 1.
-            else:
-                walk.run_for_time(TIME_INCREMENT)
-                ready, _ = walk.observe()
-                if ready:
-                    found = True
-                    output_probs[j] += 1.
+def mc_create_plot_output_ready_prob(walk: RandomWalk, sampling_period: int, trials: int = 500, exact: bool = False,
+                                     workers: int = 1, confidence: float = 0.95, fast_forward: bool = False,
+                                     random_seed = None, time_increment: int = 50):
+    max_time = sampling_period * 2
 
-    for i in range(num_increments):
-        output_probs[i] /= float(TRIALS)
+    num_increments = int(max_time / time_increment)
+    print(num_increments, "increments")
+
+    # every trial (and the exact curve) starts on a uniform node with neither half reset, unlike a sampling walker,
+    # whose first observation is always independent
+    if exact:
+        output_probs = mc_output_ready_probs(walk.graph, time_increment, num_increments, reset=False)
+    else:
+        output_probs = simulate_output_ready_probs(walk, trials, time_increment, num_increments, workers, fast_forward,
+                                                   {"reset": False}, random_seed)
 
     df = pd.DataFrame({
-        "sampling_periods": np.arange(0, max_time, TIME_INCREMENT),
+        "sampling_periods": np.arange(0, max_time, time_increment)[:num_increments],
         "output_probs": output_probs
     })
-
-    plt = ggplot(df, aes(x = "sampling_periods", y = "output_probs")) + \
-        geom_point() + \
-        geom_line(aes(group = 1), color = "red") + \
-        labs(title = f"Monte Carlo Model - Simulated Probability of Observing an\nIndependent Sample By the Nth Timestep",
-                x = f"Number of Timesteps Waited", y = f"Probability of Independent Sample ({TRIALS} trials)")
-    plt.save("plot.png")
\ No newline at end of file
+    save_plot(df, "sampling_periods",
+              f"Monte Carlo Model - Simulated Probability of Observing an\nIndependent Sample By the Nth Timestep",
+              f"Number of Timesteps Waited", f"Probability of Independent Sample\nfrom Neither Half Reset", exact, trials,
+              confidence)
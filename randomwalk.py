@@ -1,24 +1,165 @@
 from graph import *
-import random
+from chains import ChainSegments
+from collections import Counter
+import time as timer
+
+# a numpy Generator whose uniform and standard exponential draws are made a block at a time.
+# random_seed can be anything np.random.default_rng takes, including a SeedSequence from spawn_seeds
+class RandomStream:
+    def __init__(self, random_seed = None, block_size: int = 4096):
+        self.generator = np.random.default_rng(random_seed)
+        self.block_size = block_size
+        self.refill()
+
+    def refill(self):
+        self.uniforms = self.generator.random(self.block_size).tolist()
+        self.exponentials = self.generator.standard_exponential(self.block_size).tolist()
+        self.position = 0
+
+    # one uniform on [0, 1) and one Exp(1) draw
+    def next_pair(self) -> tuple[float, float]:
+        if self.position == self.block_size:
+            self.refill()
+        i = self.position
+        self.position += 1
+        return self.uniforms[i], self.exponentials[i]
+
+    def choice(self, items: list):
+        return items[int(self.generator.integers(len(items)))]
+
+# independent seeds for walkers that run in parallel
+def spawn_seeds(random_seed, n: int) -> list[np.random.SeedSequence]:
+    if not isinstance(random_seed, np.random.SeedSequence):
+        random_seed = np.random.SeedSequence(random_seed)
+    return random_seed.spawn(n)
 
 class RandomWalk:
     def __init__(self, graph: Graph, start: Node, random_seed = None):
         self.graph = graph
         self.current_node = start
-        self.random = random.Random(random_seed)
+        self.random = random_seed if isinstance(random_seed, RandomStream) else RandomStream(random_seed)
         self.time = 0
+        self.steps = 0
+        self.moves = 0 # iterations of run_for_time with fast-forward on, a whole segment crossing counting as one
+        self.csr = None
+        self.segments: ChainSegments = None
+        self.segment_visits: Counter = None # hops inside segments per node type, counted when set (see instrumentation)
 
+    # jump chain form of racing an Exp(1) clock per neighbor: the winner is a uniform neighbor
+    # and the winning time is Exp(degree), so one uniform and one exponential draw per hop
     def step(self) -> Node:
-        neighbors = self.graph.adj_list[self.current_node]
-        hop = {neighbor: random.expovariate(1) for neighbor in neighbors}
-        self.current_node = min(neighbors, key=lambda n: hop[n])
-        self.time += min(hop.values())
+        u, e = self.random.next_pair()
+        if self.graph.frozen:
+            if self.csr is None: # memoryviews give fast scalar reads of the CSR arrays without copying them
+                self.csr = (self.graph.nodes, memoryview(self.graph.indptr), memoryview(self.graph.indices))
+            nodes, indptr, indices = self.csr
+            i = self.current_node.id
+            lo = indptr[i]
+            degree = indptr[i + 1] - lo
+            self.current_node = nodes[indices[lo + int(u * degree)]]
+        else:
+            neighbors = self.graph.adj_list[self.current_node]
+            degree = len(neighbors)
+            self.current_node = neighbors[int(u * degree)]
+        self.time += e / degree
+        self.steps += 1
         return self.current_node
     
+    # subclasses that track state along the path are called after every move of current_node
+    def visited(self):
+        pass
+
+    # puts the walker on node as if it had walked for an unbounded time since the last observation, e.g. onto an
+    # exact stationary sample (Graph.random_node, the stationary distribution being uniform)
+    def jump_to(self, node: Node):
+        self.current_node = node
+        self.visited()
+
+    # node ids that the walk has to step onto one hop at a time, see visited()
+    def pinned_nodes(self) -> set[int]:
+        return set()
+
+    # from now on run_for_time crosses long chains (see chains.ChainSegments) in one move, with the
+    # same distribution of exit node and time as stepping through them
+    def enable_fast_forward(self, segments: ChainSegments = None):
+        self.graph.freeze()
+        self.segments = segments or ChainSegments(self.graph, self.pinned_nodes())
+
     def run_for_time(self, time: float):
         start = self.time
-        while self.time <= start + time:
-            self.step()
+        if self.segments is None:
+            while self.time <= start + time:
+                self.step()
+            return
+        target = start + time
+        segment_of = self.segments.segment_view
+        while self.time <= target:
+            self.moves += 1
+            if segment_of[self.current_node.id] >= 0:
+                node, self.time, steps = self.segments.advance(self.current_node.id, self.time, target, self.random,
+                                                                self.segment_visits)
+                self.steps += steps
+                self.current_node = self.graph.nodes[node]
+                self.visited()
+            else:
+                self.step()
 
     def observe(self) -> tuple[bool, Node]:
-        pass
\ No newline at end of file
+        pass
+
+# many independent walkers with the same semantics as RandomWalk, kept as node ids in NumPy arrays.
+# each hop is a uniform neighbor after an Exp(degree) holding time, which is exactly the minimum of
+# the per-neighbor Exp(1) clocks that RandomWalk.step draws
+class BatchRandomWalk:
+    def __init__(self, graph: Graph, starts: np.ndarray, random_seed = None):
+        graph.freeze()
+        self.graph = graph
+        self.indptr = graph.indptr
+        self.indices = graph.indices
+        self.degrees = np.diff(graph.indptr)
+        self.positions = np.array(starts, dtype=np.int64)
+        self.times = np.zeros(len(self.positions))
+        self.rng = np.random.default_rng(random_seed)
+        self.steps = 0
+        self.step_seconds = 0.
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def step(self, walkers: np.ndarray = None) -> np.ndarray:
+        if walkers is None:
+            walkers = np.arange(len(self.positions))
+        positions = self.positions[walkers]
+        degrees = self.degrees[positions]
+        self.times[walkers] += self.rng.standard_exponential(len(walkers)) / degrees
+        offsets = (self.rng.random(len(walkers)) * degrees).astype(np.int64)
+        positions = self.indices[self.indptr[positions] + offsets]
+        self.positions[walkers] = positions
+        self.visited(walkers, positions)
+        self.steps += len(walkers)
+        return positions
+
+    # called after every batched hop, for subclasses that track state along the path
+    def visited(self, walkers: np.ndarray, positions: np.ndarray):
+        pass
+
+    # runs walkers (all of them by default) for time each, the others stay where they are
+    def run_for_time(self, time: float, walkers: np.ndarray = None):
+        start = timer.perf_counter()
+        targets = self.times + time
+        active = np.arange(len(self.positions)) if walkers is None else walkers
+        while True:
+            active = active[self.times[active] <= targets[active]]
+            if len(active) == 0:
+                break
+            self.step(active)
+        self.step_seconds += timer.perf_counter() - start
+
+    def steps_per_second(self) -> float:
+        return self.steps / self.step_seconds if self.step_seconds > 0 else 0.
+
+    def current_nodes(self) -> list[Node]:
+        return [self.graph.nodes[i] for i in self.positions.tolist()]
+
+    def observe(self) -> tuple[np.ndarray, np.ndarray]:
+        pass
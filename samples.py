@@ -0,0 +1,102 @@
+from las_vegas import HALVES
+import numpy as np
+import json
+import queue
+import sys
+import threading
+import time
+
+# one record per observation of simulate.py: which half produced the output (None when the observation wasn't
+# ready), the random input, the output tape, whether the observation was ready (for mc: whether the outputting half
+# was reset since its last observation) and the simulated time of the observation
+SAMPLE_FIELDS = ('half', 'randomness', 'tape', 'ready', 'time')
+
+def sample_dtype(random_bits: int, tape_length: int) -> np.dtype:
+    return np.dtype([('half', np.int8), ('randomness', f'U{max(random_bits, 1)}'), ('tape', f'U{max(tape_length, 1)}'),
+                     ('ready', np.bool_), ('time', np.float64)])
+
+# Writes samples on a background thread, so that the walk doesn't wait on serialization or I/O. Samples are passed
+# over in batches through a bounded queue (a slow consumer eventually blocks the walk instead of filling memory).
+# format 'jsonl' writes one JSON object per line to path ('-' for stdout). format 'npy' writes a structured array
+# (see sample_dtype, half is an index into HALVES or -1) of num_samples rows to path, filled in as batches arrive
+class SampleWriter:
+    def __init__(self, path: str, format: str, random_bits: int, tape_length: int, num_samples: int = None,
+                 batch_size: int = 1024, queue_size: int = 16):
+        self.format = format
+        self.batch_size = batch_size
+        self.batch: list[tuple] = []
+        self.written = 0
+        self.error: BaseException = None
+        if format == 'jsonl':
+            self.file = sys.stdout if path == '-' else open(path, 'w', buffering = 1 << 20)
+        elif format == 'npy':
+            if num_samples is None or path == '-':
+                raise Exception("npy sample output needs a number of samples and an output file")
+            self.array = np.lib.format.open_memmap(path, mode='w+', dtype=sample_dtype(random_bits, tape_length), shape=(num_samples,))
+        else:
+            raise Exception(f"unknown sample format '{format}'")
+        self.queue: queue.Queue = queue.Queue(queue_size)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, half: str, randomness: str, tape: str, ready: bool, time: float):
+        self.batch.append((half, randomness, tape, bool(ready), float(time)))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.error is not None:
+            raise self.error
+        if self.batch:
+            self.queue.put(self.batch)
+            self.batch = []
+
+    def run(self):
+        while (batch := self.queue.get()) is not None:
+            if self.error is not None:
+                continue # keep draining so that write() never blocks on a dead writer
+            try:
+                self.write_batch(batch)
+            except BaseException as error:
+                self.error = error
+
+    def write_batch(self, batch: list[tuple]):
+        if self.format == 'jsonl':
+            self.file.write(''.join([json.dumps(dict(zip(SAMPLE_FIELDS, sample))) + '\n' for sample in batch]))
+        else:
+            rows = [(HALVES.index(half) if half is not None else -1, randomness or '', tape or '', ready, time)
+                    for half, randomness, tape, ready, time in batch]
+            self.array[self.written:self.written + len(rows)] = np.array(rows, dtype=self.array.dtype)
+        self.written += len(batch)
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        if self.format == 'jsonl':
+            self.file.flush()
+            if self.file is not sys.stdout:
+                self.file.close()
+        else:
+            self.array.flush()
+        if self.error is not None:
+            raise self.error
+
+# samples/sec and steps/sec of a sampling run, reported every interval seconds of wall time (never if interval is 0)
+class ThroughputMeter:
+    def __init__(self, interval: float, report = lambda line: print(line, file=sys.stderr, flush=True)):
+        self.interval = interval
+        self.report = report
+        self.start = self.last = time.perf_counter()
+        self.last_samples = self.last_steps = 0
+
+    def update(self, samples: int, steps: int):
+        if not self.interval:
+            return
+        now = time.perf_counter()
+        if now - self.last < self.interval:
+            return
+        elapsed = now - self.last
+        self.report(f"{samples} samples, {(samples - self.last_samples) / elapsed:.1f} samples/s, "
+                    f"{(steps - self.last_steps) / elapsed:.0f} steps/s")
+        self.last, self.last_samples, self.last_steps = now, samples, steps
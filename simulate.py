@@ -2,10 +2,27 @@ from las_vegas import *
 from montecarlo import *
 from randomwalk import *
 from turing_machine import *
+from model_cache import ModelCache
+from samples import SampleWriter, ThroughputMeter
+from instrumentation import Instrumentation
+from mixing import analyze_mixing, relaxation_time, tv_mixing_time
 from plot import lv_create_plot_output_ready_prob, mc_create_plot_output_ready_prob
 import argparse
+import contextlib
+import functools
+import math
 import webbrowser, urllib.parse
+import io
+import os
+import sys
 
+# "0:10,12,20::5" -> slices of the layer list, like python indexing: [slice(0, 10), slice(12, 13), slice(20, None, 5)]
+def parse_layers(spec: str) -> list[slice]:
+    slices = []
+    for part in spec.split(','):
+        bounds = [int(bound) if bound else None for bound in part.split(':')]
+        slices.append(slice(*bounds) if len(bounds) > 1 else slice(bounds[0], bounds[0] + 1))
+    return slices
 
 def main():
     parser = argparse.ArgumentParser(prog="python3 simulate.py", 
@@ -16,41 +33,125 @@ def main():
     parser.add_argument('-b', '--tm-random-bits', required=True, type=int, help = 'number of random bits to feed into the Turing machine as input')
     parser.add_argument('-t', '--time-between-observations', dest='T', required=False, type=int, help = 'units of time in between consecutive observations, defaults to 100 * comp_length^2 * bits^2')
     parser.add_argument('-c', '--create-plot', choices=['output_ready_prob'], required=False, help='instead of running the standard simulation, output the desired plot')
+    parser.add_argument('--exact', action="store_true", help = 'with --create-plot, compute the curve exactly from the Markov chain instead of simulating trials (for mc, both start on a uniform node with neither half reset, while the sampling walk counts both as reset at the start)')
+    parser.add_argument('--trials', type=int, default=500, help = 'with --create-plot, number of simulated trials, defaults to 500')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help = 'with --create-plot, number of processes running trials in parallel, defaults to the number of CPUs')
+    parser.add_argument('--confidence', type=float, default=0.95, help = 'with --create-plot, confidence level of the error band around simulated curves, defaults to 0.95')
+    parser.add_argument('--cache-dir', default='.cache', help = 'directory for data reused across runs (Turing machine trajectories and compiled models), defaults to .cache')
+    parser.add_argument('--no-cache', action="store_true", help = 'do not read or write anything in --cache-dir')
+    parser.add_argument('--implicit', action="store_true", help = 'never build the model graph and compute the neighbors of walker states on demand (uses far less memory): for mc the product graph, for lv the whole hourglass')
+    parser.add_argument('-n', '--num-samples', type=int, help = 'stop after this many observations instead of running forever')
+    parser.add_argument('--format', choices=['text', 'jsonl', 'npy'], default='text', help = 'text prints observations for reading, jsonl and npy write one (half, randomness, tape, ready, time) record per observation')
+    parser.add_argument('-o', '--output', default='-', help = 'with --format jsonl/npy, file to write the samples to, defaults to stdout (jsonl only)')
+    parser.add_argument('--stats-interval', type=float, default=10, help = 'seconds between samples/sec and steps/sec reports on stderr, 0 to disable, defaults to 10')
+    parser.add_argument('--seed', type=int, help = 'random seed of the walk (with --create-plot, of the trials)')
+    parser.add_argument('--auto-T', type=float, metavar='TV', help = 'instead of -t, use the smallest time between observations that brings the walk within total variation TV of stationarity from any node (estimated from the spectral gap, or from the autocorrelation of a short walk for --implicit models)')
+    parser.add_argument('--fast-forward', action="store_true", help = 'cross chains of interchangeable nodes (the computation and output tracks) in one vectorized move instead of one step per hop, also in the trials of --create-plot (not for --implicit models)')
+    parser.add_argument('--perfect', action="store_true", help = 'instead of walking for -t time between observations, move the walker to an exact sample of the stationary distribution. the walk moves along every edge at rate 1, so that distribution is uniform over the nodes of the model and a sample is one uniformly drawn node')
+    parser.add_argument('--analyze-mixing', action="store_true", help = 'do not run simulation, only print the spectral gap, relaxation times and times to a few total variation targets of the model')
+    parser.add_argument('--graph-file', help = 'with --print-model, write the GraphViz document to this file instead of stdout')
+    parser.add_argument('--graph-layers', type=parse_layers, help = 'with --print-model/--interactive-graph, only draw these layers, given as comma separated indices or start:stop[:step] slices')
+    parser.add_argument('--collapse-outputs', action="store_true", help = 'with --print-model/--interactive-graph, draw every output-hold chain (for mc, paired with one computation or randomizer node) as a single node')
+    parser.add_argument('--profile', action="store_true", help = 'report time per phase (construction, turing machine, walk, observe, ...), counters and graph memory when the run ends or is interrupted')
+    parser.add_argument('--profile-output', help = 'with --profile, write the report to this file instead of stderr')
+    parser.add_argument('--profile-cprofile', action="store_true", help = 'with --profile, add a cProfile capture of the whole run to the report')
+    parser.add_argument('--profile-memory', action="store_true", help = 'with --profile, add a tracemalloc capture (peak and top allocation sites) to the report')
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-p', '--print-model', action="store_true", help = 'do not run simulation, only print the computation graph of the constructed model (prints in GraphViz format)')
     group.add_argument('-g', '--interactive-graph', action="store_true", help = 'like --print-model, but opens a web browser with an interactive view of the computation graph of the model')
 
     args = parser.parse_args()
+    if args.T is not None and args.auto_T is not None:
+        parser.error("-t and --auto-T can't be used together")
+    if args.perfect and (args.T is not None or args.auto_T is not None):
+        parser.error("--perfect can't be used with -t or --auto-T")
+    if args.fast_forward and args.implicit:
+        parser.error("--fast-forward can't be used with --implicit")
+    instrumentation = Instrumentation(args.profile, args.profile_cprofile, args.profile_memory)
+    try:
+        run(args, instrumentation)
+    except KeyboardInterrupt:
+        if not args.profile:
+            raise
+    finally: # the profile covers whatever ran, also when the simulation was interrupted
+        instrumentation.finish(args.profile_output)
+
+# everything after argument parsing, see main() for the arguments
+def run(args: argparse.Namespace, instrumentation: Instrumentation):
+    # with samples going to stdout, everything else goes to stderr
+    log = functools.partial(print, file=sys.stderr) if args.format == 'jsonl' and args.output == '-' else print
     
-    print("Parsing Turing machine configuration... ", end = '', flush=True)
-    desc = open(args.tm_filename, 'r').read()
-    tm = TuringMachine(Rules(desc), {}, args.tm_initial_state)
-    print("Done")
+    log("Parsing Turing machine configuration... ", end = '', flush=True)
+    with instrumentation.phase("parse"):
+        desc = open(args.tm_filename, 'r').read()
+        tm = TuringMachine(Rules(desc), {}, args.tm_initial_state)
+    trajectories = TrajectoryStore(None if args.no_cache else os.path.join(args.cache_dir, 'trajectories'))
+    instrumentation.instrument_trajectories(trajectories)
+    models = ModelCache(None if args.no_cache else os.path.join(args.cache_dir, 'models'))
+    # longest computation over all inputs, needed for the default times, computed at most once
+    @functools.cache
+    def longest_path() -> int:
+        with contextlib.redirect_stdout(sys.stderr) if log is not print else contextlib.nullcontext(), instrumentation.phase("longest path"):
+            return longest_computation_path(tm.rules, args.tm_initial_state, args.tm_random_bits, trajectories)
+    log("Done")
 
-    print("Constructing computation graph...", end = '', flush=True)
-    if args.model_kind == 'lv':
-        model = LasVegasSampler(args.tm_random_bits, tm)
-        walk = LasVegasRandomWalk(model)
-    elif args.model_kind == 'mc':
-        model = MonteCarloSampler(args.tm_random_bits, tm)
-        walk = MonteCarloRandomWalk(model)
-    else:
-        raise "Model type not supported (yet)"
-    print("Done")
+    log("Constructing computation graph...", end = '', flush=True)
+    with instrumentation.phase("construction"):
+        # compiled models are loaded from the model cache when possible (the implicit model is never materialized)
+        model = None if args.implicit else models.load(tm.rules, args.tm_initial_state, args.tm_random_bits, args.model_kind)
+        if model is not None:
+            log(" (loaded from cache) ", end = '')
+        if args.model_kind == 'lv':
+            if args.implicit:
+                model = ImplicitLasVegasSampler(args.tm_random_bits, tm, trajectories)
+            elif model is None:
+                model = models.save(tm.rules, args.tm_initial_state, args.tm_random_bits, 'lv',
+                                    LasVegasSampler(args.tm_random_bits, tm, trajectories).freeze())
+            walk = LasVegasRandomWalk(model)
+        elif args.model_kind == 'mc':
+            if args.implicit:
+                model = ImplicitMonteCarloSampler(args.tm_random_bits, tm, trajectories)
+            elif model is None:
+                progress = lambda done, total: log(f"\rConstructing computation graph... layer {done}/{total}", end = '', flush=True)
+                model = MonteCarloSampler(args.tm_random_bits, tm, progress, trajectories).freeze()
+                log(f" ({model.construction_time:.1f}s) ", end = '')
+                model = models.save(tm.rules, args.tm_initial_state, args.tm_random_bits, 'mc', model)
+            walk = MonteCarloRandomWalk(model)
+        else:
+            raise "Model type not supported (yet)"
+        trajectories.save()
+    instrumentation.account_graph("model", model)
+    log("Done")
 
     if args.print_model or args.interactive_graph:
         if args.model_kind == "lv":
             clusterings = [("top half", range(model.randomizer_layer_start_index)),
                            ("randomizer", range(model.randomizer_layer_start_index, model.bottom_layer_start_index)),
                            ("bottom half", range(model.bottom_layer_start_index, len(model.layers)))]
-            graphviz_string = model.to_graphviz_layered(clusterings)
+            collapse = lv_output_chain_key
         elif args.model_kind == "mc":
             clusterings = [("m = 1", range(len(model.layers) // 2)),
                            ("m = -1", range(len(model.layers) // 2, len(model.layers)))]
-            graphviz_string = model.to_graphviz_layered(clusterings)
+            collapse = mc_output_chain_key
+        layers = None
+        if args.graph_layers is not None:
+            layers = [i for layer_slice in args.graph_layers for i in range(len(model.layers))[layer_slice]]
+        graphviz_options = dict(clusterings = clusterings, layers = layers,
+                                collapse = collapse if args.collapse_outputs else None)
         if args.print_model:
-            print(graphviz_string)
+            # streamed, the document is never held in memory as a whole
+            with instrumentation.phase("graphviz export"):
+                if args.graph_file:
+                    with open(args.graph_file, 'w', buffering = 1 << 20) as file:
+                        model.write_graphviz_layered(file, **graphviz_options)
+                else:
+                    model.write_graphviz_layered(sys.stdout, **graphviz_options)
         elif args.interactive_graph:
+            # the browser gets the document in the URL, so here it has to be built in memory
+            output = io.StringIO()
+            with instrumentation.phase("graphviz export"):
+                model.write_graphviz_layered(output, **graphviz_options)
+            graphviz_string = output.getvalue()
             quoted_string = urllib.parse.quote(graphviz_string, safe="")
             url = "https://dreampuf.github.io/GraphvizOnline/#" + quoted_string
             try:
@@ -61,38 +162,78 @@ def main():
                 print("Graph is too big to be passed in the command line. Go to http://magjac.com/graphviz-visual-editor/ and paste the contents of the generated graph.txt")
         return
     
+    if args.analyze_mixing or args.auto_T is not None:
+        log("Analyzing mixing of the walk...", end = '', flush=True)
+        with instrumentation.phase("mixing analysis"):
+            mixing_walk = LasVegasRandomWalk(model, args.seed) if args.model_kind == 'lv' else MonteCarloRandomWalk(model, args.seed)
+            # the walk is read every bits^2 + comp_length time units when there is no spectral estimate to scale by.
+            # --auto-T only needs the spectral estimate, --analyze-mixing compares it with the empirical one
+            analysis = analyze_mixing(model, mixing_walk, args.tm_random_bits ** 2 + longest_path(), compare=args.analyze_mixing)
+        log("Done")
+        if args.analyze_mixing:
+            for name, value in analysis.items():
+                log(f"{name}: {value}")
+            for tv in sorted({0.25, 0.01} | ({args.auto_T} if args.auto_T is not None else set()), reverse=True):
+                log(f"time to total variation {tv}: {tv_mixing_time(relaxation_time(analysis), analysis['nodes'], tv):.1f}")
+            log(f"default time between observations: {100 * (args.tm_random_bits ** 2 + longest_path())}")
+            return
+        args.T = max(1, math.ceil(tv_mixing_time(relaxation_time(analysis), analysis["nodes"], args.auto_T)))
+        log(f"Time between observations for total variation {args.auto_T}: {args.T}")
+
     match args.create_plot:
         case 'output_ready_prob':
-            print("Generating plot 'output ready probability' from samples...", end = '', flush=True)
-            sampling_period = 15 * (args.tm_random_bits ** 2 + longest_computation_path(tm.rules, args.tm_initial_state, args.tm_random_bits))
-            if args.model_kind == 'lv':
-                lv_create_plot_output_ready_prob(walk, sampling_period)
-            elif args.model_kind == 'mc':
-                mc_create_plot_output_ready_prob(walk, sampling_period)
-            print("Done")
+            log("Generating plot 'output ready probability' from samples...", end = '', flush=True)
+            sampling_period = 15 * (args.tm_random_bits ** 2 + longest_path())
+            with instrumentation.phase("plot"):
+                if args.model_kind == 'lv':
+                    lv_create_plot_output_ready_prob(walk, sampling_period, args.trials, args.exact, args.workers, args.confidence,
+                                                     args.fast_forward, args.seed)
+                elif args.model_kind == 'mc':
+                    mc_create_plot_output_ready_prob(walk, sampling_period, args.trials, args.exact, args.workers, args.confidence,
+                                                     args.fast_forward, args.seed)
+            log("Done")
             return
         case _:
             pass
 
-    print("Beginning simulation.")
-    if args.model_kind == 'lv':
-        walk = LasVegasRandomWalk(model)
-        run_time = args.T or 100 * (args.tm_random_bits ** 2 + longest_computation_path(tm.rules, args.tm_initial_state, args.tm_random_bits))
-        while True:
-            walk.run_for_time(run_time)
-            ready, node = walk.observe()
-            if ready:
-                print('Observation: half =', node.data['half'], '-- input =', node.data['randomness'], '-> output =', node.data['tape'])
+    log("Beginning simulation.")
+    walk = LasVegasRandomWalk(model, args.seed) if args.model_kind == 'lv' else MonteCarloRandomWalk(model, args.seed)
+    if args.fast_forward:
+        with instrumentation.phase("chain segments"):
+            walk.enable_fast_forward()
+    instrumentation.instrument_walk(walk)
+    run_time = None if args.perfect else args.T or 100 * (args.tm_random_bits ** 2 + longest_path())
+    writer = None
+    if args.format != 'text':
+        # a tape grows by at most one cell per step of the computation
+        writer = SampleWriter(args.output, args.format, args.tm_random_bits, args.tm_random_bits + longest_path(), args.num_samples)
+    meter = ThroughputMeter(args.stats_interval)
+    samples = 0
+    try:
+        while args.num_samples is None or samples < args.num_samples:
+            if args.perfect:
+                walk.jump_to(model.random_node(walk.random.generator))
             else:
-                print('Observation not ready')
-    if args.model_kind == 'mc':
-        walk = MonteCarloRandomWalk(model)
-        run_time = args.T or 100 * (args.tm_random_bits ** 2 + longest_computation_path(tm.rules, args.tm_initial_state, args.tm_random_bits))
-        while True:
-            walk.run_for_time(run_time)
+                walk.run_for_time(run_time)
             ready, node = walk.observe()
-            half, output_node = outputting_half_of_monte_carlo_node(node)
-            print('Observation: half =', half, '-- input =', output_node.data['randomness'], '-> output =', output_node.data['tape'], '-- was_reset =', ready)
+            if args.model_kind == 'lv':
+                half, output_node = (node.data['half'], node) if ready else (None, None)
+            else:
+                half, output_node = outputting_half_of_monte_carlo_node(node)
+            with instrumentation.phase("output"):
+                if writer is not None:
+                    writer.write(half, output_node and output_node.data['randomness'], output_node and output_node.data['tape'], ready, walk.time)
+                elif args.model_kind == 'lv' and ready:
+                    print('Observation: half =', half, '-- input =', output_node.data['randomness'], '-> output =', output_node.data['tape'])
+                elif args.model_kind == 'lv':
+                    print('Observation not ready')
+                else:
+                    print('Observation: half =', half, '-- input =', output_node.data['randomness'], '-> output =', output_node.data['tape'], '-- was_reset =', ready)
+            samples += 1
+            meter.update(samples, walk.steps)
+    finally:
+        if writer is not None:
+            writer.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,168 @@
+from las_vegas import LasVegasSampler, LasVegasRandomWalk
+from montecarlo import MonteCarloSampler, MonteCarloRandomWalk
+from turing_machine import TuringMachine, Rules, longest_computation_path
+from trajectory import TrajectoryStore
+from model_cache import ModelCache
+from graph import Graph
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
+import contextlib
+import csv
+import importlib.util
+import io
+import itertools
+import json
+import os
+import time
+
+# Runs simulate.py's sampling loop over a grid of (machine, random bits, model kind, time between observations,
+# seed) points on a process pool and collects one row of results per point in a single CSV (or Parquet) table.
+# Models are built once per (machine, random bits, model kind) into the model cache before any point runs, and the
+# points load them from there (memory-mapped, so the workers share the pages). Points already in the table are
+# skipped, so an interrupted or extended sweep only runs what's missing.
+
+# columns that identify a grid point, the rest of a row are its results
+KEY_COLUMNS = ('machine', 'initial_state', 'fingerprint', 'bits', 'model', 'T', 'samples', 'seed')
+RESULT_COLUMNS = ('time_between_observations', 'ready', 'ready_rate', 'simulated_time', 'steps', 'load_seconds',
+                  'wall_seconds', 'steps_per_second', 'ready_per_second')
+
+# a grid spec is a JSON object like {"machines": {"computation.tm": "a"}, "bits": [2, 3], "models": ["lv", "mc"],
+# "T": [null, 1000], "samples": 500, "seeds": [0]}: machines map .tm files to their initial state, T null is
+# simulate.py's default 100 * (bits^2 + longest computation), seeds defaults to [0]
+def grid_points(spec: dict) -> list[dict]:
+    points = []
+    for (machine, initial_state), bits, model, T, seed in itertools.product(spec['machines'].items(), spec['bits'], spec['models'],
+                                                                           spec.get('T', [None]), spec.get('seeds', [0])):
+        if model not in ('lv', 'mc'):
+            raise Exception(f"unknown model kind '{model}' in the grid spec")
+        fingerprint = Rules(open(machine, 'r').read()).fingerprint
+        points.append({'machine': machine, 'initial_state': initial_state, 'fingerprint': fingerprint, 'bits': bits,
+                       'model': model, 'T': 'default' if T is None else str(T), 'samples': spec['samples'], 'seed': seed})
+    return points
+
+def point_key(row: dict) -> tuple[str, ...]:
+    return tuple(str(row[column]) for column in KEY_COLUMNS)
+
+# pandas for the .parquet tables, which also need pyarrow or fastparquet (not in requirements.txt)
+def parquet_pandas():
+    if importlib.util.find_spec('pyarrow') is None and importlib.util.find_spec('fastparquet') is None:
+        raise Exception("a .parquet results table needs pyarrow (pip install pyarrow), use a .csv name otherwise")
+    import pandas as pd
+    return pd
+
+def read_table(path: str) -> list[dict]:
+    if not os.path.exists(path):
+        return []
+    if path.endswith('.parquet'):
+        return parquet_pandas().read_parquet(path).to_dict('records')
+    with open(path, 'r', newline='') as file:
+        return list(csv.DictReader(file))
+
+# the whole table is rewritten under a temporary name and renamed, so an interrupted sweep never leaves half a row
+def write_table(path: str, rows: list[dict]):
+    temporary = f"{path}.{os.getpid()}.tmp"
+    if path.endswith('.parquet'):
+        parquet_pandas().DataFrame(rows, columns=KEY_COLUMNS + RESULT_COLUMNS).to_parquet(temporary, index=False)
+    else:
+        with open(temporary, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=KEY_COLUMNS + RESULT_COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+    os.replace(temporary, path)
+
+def caches(cache_dir: str) -> tuple[TrajectoryStore, ModelCache]:
+    return TrajectoryStore(os.path.join(cache_dir, 'trajectories')), ModelCache(os.path.join(cache_dir, 'models'))
+
+def compiled_model(tm: TuringMachine, random_bits: int, model_kind: str, trajectories: TrajectoryStore, models: ModelCache) -> Graph:
+    model = models.load(tm.rules, tm.state, random_bits, model_kind)
+    if model is None:
+        sampler = LasVegasSampler(random_bits, tm, trajectories) if model_kind == 'lv' \
+            else MonteCarloSampler(random_bits, tm, trajectories=trajectories)
+        model = models.save(tm.rules, tm.state, random_bits, model_kind, sampler.freeze())
+    return model
+
+# builds the models of one machine for every (bits, model kind) and returns its longest computation per bits. one
+# task per machine, so that no two processes write the same trajectory file
+def prepare_machine(machine: str, initial_state: str, models_needed: list[tuple[int, str]], cache_dir: str) -> dict[int, int]:
+    tm = TuringMachine(Rules(open(machine, 'r').read()), {}, initial_state)
+    trajectories, models = caches(cache_dir)
+    longest = {}
+    for random_bits, model_kind in models_needed:
+        compiled_model(tm, random_bits, model_kind, trajectories, models)
+        if random_bits not in longest:
+            with contextlib.redirect_stdout(io.StringIO()):
+                longest[random_bits] = longest_computation_path(tm.rules, initial_state, random_bits, trajectories)
+    trajectories.save()
+    return longest
+
+# the sampling loop of simulate.py for one grid point, timed and counted
+def run_point(point: dict, longest: int, cache_dir: str) -> dict:
+    start = time.perf_counter()
+    tm = TuringMachine(Rules(open(point['machine'], 'r').read()), {}, point['initial_state'])
+    trajectories, models = caches(cache_dir)
+    model = compiled_model(tm, point['bits'], point['model'], trajectories, models)
+    walk = LasVegasRandomWalk(model, point['seed']) if point['model'] == 'lv' else MonteCarloRandomWalk(model, point['seed'])
+    run_time = 100 * (point['bits'] ** 2 + longest) if point['T'] == 'default' else float(point['T'])
+    load_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ready = 0
+    for _ in range(point['samples']):
+        walk.run_for_time(run_time)
+        ready += bool(walk.observe()[0])
+    wall_seconds = time.perf_counter() - start
+    return {**point, 'time_between_observations': run_time, 'ready': ready, 'ready_rate': ready / max(point['samples'], 1),
+            'simulated_time': walk.time, 'steps': walk.steps, 'load_seconds': load_seconds, 'wall_seconds': wall_seconds,
+            'steps_per_second': walk.steps / wall_seconds if wall_seconds > 0 else 0.,
+            'ready_per_second': ready / wall_seconds if wall_seconds > 0 else 0.}
+
+def run_sweep(points: list[dict], output: str, workers: int, cache_dir: str, report = print) -> list[dict]:
+    rows = read_table(output)
+    done = {point_key(row) for row in rows}
+    todo = [point for point in points if point_key(point) not in done]
+    report(f"{len(points) - len(todo)} of {len(points)} grid points already in {output}, {len(todo)} to run")
+    if not todo:
+        return rows
+
+    machines: dict[tuple[str, str], list[tuple[int, str]]] = {}
+    for point in todo:
+        needed = machines.setdefault((point['machine'], point['initial_state']), [])
+        if (point['bits'], point['model']) not in needed:
+            needed.append((point['bits'], point['model']))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(prepare_machine, machine, initial_state, needed, cache_dir): (machine, initial_state)
+                   for (machine, initial_state), needed in machines.items()}
+        longest = {futures[future]: future.result() for future in as_completed(futures)}
+        report(f"models ready for {len(machines)} machine(s)")
+
+        futures = [pool.submit(run_point, point, longest[(point['machine'], point['initial_state'])][point['bits']], cache_dir)
+                   for point in todo]
+        for i, future in enumerate(as_completed(futures)):
+            row = future.result()
+            rows.append(row)
+            write_table(output, rows)
+            report(f"[{i + 1}/{len(todo)}] {row['machine']} bits={row['bits']} {row['model']} T={row['T']} seed={row['seed']}: "
+                   f"ready rate {row['ready_rate']:.3f}, {row['ready_per_second']:.1f} ready/s, {row['steps_per_second']:.0f} steps/s")
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(prog="python3 sweep.py",
+        description="Runs the simulation over a grid of machines, random bits, model kinds, observation intervals and "
+                    "seeds, and collects the results in one table")
+    parser.add_argument('grid', help = 'JSON grid spec, or the path of a file with one, e.g. {"machines": {"computation.tm": "a"}, "bits": [2, 3], "models": ["lv", "mc"], "T": [null, 1000], "samples": 500, "seeds": [0]}')
+    parser.add_argument('-o', '--output', default='sweep.csv', help = 'results table, CSV or (with a .parquet name) Parquet, defaults to sweep.csv. grid points already in it are skipped')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help = 'number of processes running grid points in parallel, defaults to the number of CPUs')
+    parser.add_argument('--cache-dir', default='.cache', help = 'directory of the trajectory and model caches shared with simulate.py, defaults to .cache')
+    args = parser.parse_args()
+
+    if args.output.endswith('.parquet'): # fail before running anything
+        parquet_pandas()
+    if args.grid.lstrip().startswith('{'):
+        spec = json.loads(args.grid)
+    else:
+        with open(args.grid, 'r') as file:
+            spec = json.load(file)
+    run_sweep(grid_points(spec), args.output, args.workers, args.cache_dir, lambda line: print(line, flush=True))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+from las_vegas import LasVegasSampler, ImplicitLasVegasSampler, LasVegasRandomWalk, BatchLasVegasRandomWalk
+from montecarlo import MonteCarloSampler, ImplicitMonteCarloSampler, MonteCarloRandomWalk, BatchMonteCarloRandomWalk, mc_output_chain_key
+from transient import lv_output_ready_probs, mc_output_ready_probs
+from turing_machine import TuringMachine, Rules, BatchTuringMachine, binary_string
+from trajectory import Trajectory, TrajectoryStore
+from graph import Graph, Node
+from model_cache import ModelCache
+from instrumentation import Instrumentation
+from mixing import analyze_mixing, relaxation_time
+from attributes import node_attributes
+from scipy.stats import chi2_contingency
+import chains
+import numpy as np
+import hashlib
+import io
+import os
+import re
+import pytest
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# halts right away on a 0 and runs over the whole input on 1s, so its computations differ in length and its Monte
+# Carlo model has product states where both halves or neither are outputting
+VARIABLE_LENGTH_RULES = """
+a, 0 -> 0, halt
+a, 1 -> 1, b
+a, _ -> 1, halt
+
+b -> R, a
+"""
+
+def bundled_machine(name: str) -> TuringMachine:
+    return TuringMachine(Rules(open(os.path.join(DIRECTORY, name), 'r').read()), {}, 'a')
+
+def variable_length_machine() -> TuringMachine:
+    return TuringMachine(Rules(VARIABLE_LENGTH_RULES), {}, 'a')
+
+def node_count(document: str) -> int:
+    return sum(1 for line in document.splitlines() if re.match(r'\s*\d+ \[tooltip=', line))
+
+@pytest.mark.parametrize("make_machine", [lambda: bundled_machine("computation.tm"), variable_length_machine])
+def test_mc_collapse_outputs(make_machine):
+    model = MonteCarloSampler(2, make_machine()).freeze()
+    for node in model.nodes:
+        outputting = [node.data[half].type == "output" for half in ("top", "bottom")]
+        assert (mc_output_chain_key(node) is None) == (outputting[0] == outputting[1])
+    full, collapsed = io.StringIO(), io.StringIO()
+    model.write_graphviz_layered(full)
+    model.write_graphviz_layered(collapsed, collapse=mc_output_chain_key)
+    assert 0 < node_count(collapsed.getvalue()) < node_count(full.getvalue())
+
+# the walkers read halves and reset flags from per-node codes, which on a built model must not compute any tape
+@pytest.mark.parametrize("make_walk", [lambda tm: LasVegasRandomWalk(LasVegasSampler(3, tm).freeze(), 0),
+                                       lambda tm: MonteCarloRandomWalk(MonteCarloSampler(2, tm).freeze(), 0)])
+def test_walk_on_built_model_computes_no_tapes(make_walk, monkeypatch):
+    walk = make_walk(bundled_machine("computation.tm"))
+    def tape_string(self, step):
+        raise AssertionError("a tape was computed")
+    monkeypatch.setattr(Trajectory, "tape_string", tape_string)
+    for _ in range(20):
+        walk.run_for_time(10)
+        walk.observe()
+
+# layers a Las Vegas walker started on the first layer is in after a short run, with and without fast-forward,
+# for fast-forward that takes only single hops, only vectorized blocks and the default mix of both
+@pytest.mark.parametrize("scalar_hops", [0, chains.SCALAR_HOPS, 10 ** 9])
+def test_fast_forward_layer_histogram(scalar_hops, monkeypatch):
+    monkeypatch.setattr(chains, "SCALAR_HOPS", scalar_hops)
+    model = LasVegasSampler(3, bundled_machine("computation.tm")).freeze()
+    layer = node_attributes(model).layer
+    segments = chains.ChainSegments(model, LasVegasRandomWalk(model, 0).pinned_nodes())
+    trials = 1000
+    histograms = np.zeros((2, len(model.layers)), dtype=np.int64)
+    for fast_forward in (0, 1):
+        for seed in range(trials):
+            walk = LasVegasRandomWalk(model, [fast_forward, seed])
+            walk.jump_to(model.layers[0][0])
+            if fast_forward:
+                walk.enable_fast_forward(segments)
+            walk.run_for_time(20)
+            histograms[fast_forward, layer[walk.current_node.id]] += 1
+    assert chi2_contingency(histograms[:, histograms.sum(axis=0) > 0]).pvalue > 0.001
+
+# the fraction of seeded batched walkers with a ready observation by each measurement (the simulated curves of plot.py)
+# stays within a binomial band of 4 standard deviations around the exact curve of transient.py. Monte Carlo walkers
+# start with no half reset, as in the plot, since otherwise their first observation is always ready
+@pytest.mark.parametrize("sampler, batch_walk, exact_probs, period, options", [
+    (LasVegasSampler, BatchLasVegasRandomWalk, lv_output_ready_probs, 20., {}),
+    (MonteCarloSampler, BatchMonteCarloRandomWalk, mc_output_ready_probs, 5., {"reset": False})])
+def test_batch_walk_matches_exact_curve(sampler, batch_walk, exact_probs, period, options):
+    model = sampler(2, bundled_machine("computation.tm")).freeze()
+    trials, measurements = 4000, 15
+    batch = batch_walk(model, trials, 0, **options)
+    counts = np.zeros(measurements)
+    active = np.arange(trials)
+    for j in range(measurements):
+        batch.run_for_time(period, active)
+        ready, _ = batch.observe()
+        counts[j:] += np.count_nonzero(ready[active])
+        active = active[~ready[active]]
+    exact = exact_probs(model, period, measurements, **options)
+    band = 4 * np.sqrt(exact * (1 - exact) / trials) + 1 / trials
+    assert 0.5 < exact[-1] and (np.abs(counts / trials - exact) <= band).all()
+
+# digest of a model's construction: every node in insertion order with its name, type, data (component nodes by name)
+# and the sorted names of its neighbors
+def construction_digest(model: Graph) -> str:
+    def value(v) -> str:
+        return v.name if isinstance(v, Node) else repr(v)
+    lines = []
+    for node, neighbors in model.adj_list.items():
+        data = node.data or {}
+        lines.append("|".join([node.name, node.type, ",".join(f"{key}={value(data[key])}" for key in sorted(data)),
+                               ",".join(sorted(neighbor.name for neighbor in neighbors))]))
+    return hashlib.sha256("\n".join(lines).encode()).hexdigest()
+
+# 2-bit models as the original graph construction (before GraphBuilder, the O(|other|) union and the compact half
+# hourglass) built them
+@pytest.mark.parametrize("sampler, machine, digest", [
+    (LasVegasSampler, "computation.tm", "d34c89faece8832f5e896e4a0c8bf16144e9af7de9f36b49fe04524822aa6c5f"),
+    (LasVegasSampler, "computation2.tm", "f8916edb9d85f95acc29fae5a10f45c2b9eff9245b024f140ff17b89aabf9d01"),
+    (LasVegasSampler, "computation3.tm", "3d514a8c8c7798ac4cf6c61ef4c3007b1558c35f2df02bb1fe2e64e01924d2f1"),
+    (MonteCarloSampler, "computation.tm", "edd07bdfb024d06fc62eb729a1a04140c3bed8645e6ec1d34f777cf511715213"),
+    (MonteCarloSampler, "computation2.tm", "edd07bdfb024d06fc62eb729a1a04140c3bed8645e6ec1d34f777cf511715213"),
+    (MonteCarloSampler, "computation3.tm", "aee408ecc419bd4d4ebd02a81fbae2b5c1eae75c3def3b78dd975c9e1b68db15")])
+def test_construction_matches_original(sampler, machine, digest):
+    assert construction_digest(sampler(2, bundled_machine(machine))) == digest
+
+# TuringMachine and BatchTuringMachine go through the same configurations, step for step, running forward and in
+# reverse from every 3-bit input
+@pytest.mark.parametrize("machine", ["computation.tm", "computation2.tm", "computation3.tm", None])
+def test_turing_machine_engines_agree(machine):
+    tm = bundled_machine(machine) if machine else variable_length_machine()
+    tapes = [{i: c for i, c in enumerate(binary_string(inp, bits=3))} for inp in range(8)]
+    for direction in ("forward", "reverse"):
+        machines = [TuringMachine(tm.rules, tape, tm.state) for tape in tapes]
+        batch = BatchTuringMachine(tm.rules, tapes, tm.state, direction)
+        steps = [0] * len(machines)
+        while not all(m.halted for m in machines):
+            batch.step()
+            for i, m in enumerate(machines):
+                if not m.halted and not getattr(m, direction)():
+                    steps[i] += 1
+            assert batch.halted.tolist() == [m.halted for m in machines]
+            assert batch.steps.tolist() == steps
+            # -1 is an initial state that has no rules, and so no index
+            assert [batch.compiled.states[state] if state >= 0 else tm.state for state in batch.state.tolist()] == [m.state for m in machines]
+            assert batch.head_loc.tolist() == [m.head_loc for m in machines]
+            assert batch.tapes() == [m.tape for m in machines]
+
+# trajectories saved by one store are loaded by another (without unpickling) with the same configurations at every
+# step, checkpoints included
+def test_trajectory_store_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(Trajectory, "CHECKPOINT_INTERVAL", 2)
+    tm = variable_length_machine()
+    saved = TrajectoryStore(str(tmp_path))
+    LasVegasSampler(3, tm, saved)
+    saved.save()
+    loaded = TrajectoryStore(str(tmp_path))
+    for key, trajectory in saved.trajectories(tm.rules, tm.state).items():
+        head, tape = key
+        copy = loaded.get(TuringMachine(tm.rules, dict(tape), tm.state))
+        assert len(copy) == len(trajectory)
+        for step in range(len(trajectory)):
+            assert (copy.head(step), copy.state(step), copy.tape(step)) == (trajectory.head(step), trajectory.state(step), trajectory.tape(step))
+    assert loaded.misses == 0 and loaded.hits > 0
+
+# a model loaded from the model cache has the nodes, layers and GraphViz output of the model that was saved, and seeded
+# walks on both go through the same nodes. its nodes are only made when they are looked at
+@pytest.mark.parametrize("kind, sampler, walk_class", [("lv", LasVegasSampler, LasVegasRandomWalk),
+                                                       ("mc", MonteCarloSampler, MonteCarloRandomWalk)])
+def test_model_cache_round_trip(kind, sampler, walk_class, tmp_path):
+    tm = bundled_machine("computation.tm")
+    models = ModelCache(str(tmp_path))
+    model = models.save(tm.rules, tm.state, 2, kind, sampler(2, tm).freeze())
+    loaded = models.load(tm.rules, tm.state, 2, kind)
+    assert loaded.nodes.made.count(None) == len(model.nodes)
+    assert (node_attributes(loaded).layer == node_attributes(model).layer).all()
+    assert loaded.nodes.made.count(None) == len(model.nodes)
+    assert loaded.describe_stationary_distribution_by_layer() == model.describe_stationary_distribution_by_layer()
+    def describe(node: Node) -> tuple:
+        return node.name, node.type, {key: value.name if isinstance(value, Node) else value for key, value in (node.data or {}).items()}
+    assert [describe(node) for node in loaded.nodes] == [describe(node) for node in model.nodes]
+    assert [[node.id for node in layer] for layer in loaded.layers] == [[node.id for node in layer] for layer in model.layers]
+    assert loaded.to_graphviz_layered() == model.to_graphviz_layered()
+    walks = [walk_class(model, 0), walk_class(loaded, 0)]
+    for _ in range(50):
+        for walk in walks:
+            walk.run_for_time(3)
+        observations = [walk.observe() for walk in walks]
+        assert observations[0][0] == observations[1][0] and observations[0][1].id == observations[1][1].id
+
+# under --profile every hop is counted as a visit to the type of the node it lands on, fast-forwarded hops included
+@pytest.mark.parametrize("scalar_hops", [0, chains.SCALAR_HOPS])
+def test_profile_counts_fast_forward_visits(scalar_hops, monkeypatch):
+    monkeypatch.setattr(chains, "SCALAR_HOPS", scalar_hops)
+    walk = LasVegasRandomWalk(LasVegasSampler(3, bundled_machine("computation.tm")).freeze(), 0)
+    instrumentation = Instrumentation(enabled=True)
+    instrumentation.instrument_walk(walk)
+    walk.enable_fast_forward()
+    for _ in range(50):
+        walk.run_for_time(20)
+    counters = instrumentation.report().split("counters:")[1]
+    visits = sum(int(line.split()[-1]) for line in counters.splitlines() if line.strip().startswith("visits: "))
+    assert sum(walk.segment_visits.values()) > 0 and visits == walk.steps
+
+# what identifies a node across the explicit and implicit models: name, type and data, product nodes (which are
+# numbered in the explicit model) by their type and the names of their components
+def node_key(node: Node) -> tuple:
+    if "top" in node.data:
+        return node.type, node.data["top"].name, node.data["bottom"].name
+    return node.name, node.type, dict(node.data)
+
+# the implicit samplers compute the nodes, neighbor lists (in order) and layers of the samplers that build the graph,
+# so seeded walks started on the same node go through the same nodes on both
+@pytest.mark.parametrize("machine", ["computation.tm", "computation2.tm"])
+@pytest.mark.parametrize("bits", [1, 2, 3])
+@pytest.mark.parametrize("sampler, implicit_sampler, walk_class", [
+    (LasVegasSampler, ImplicitLasVegasSampler, LasVegasRandomWalk),
+    (MonteCarloSampler, ImplicitMonteCarloSampler, MonteCarloRandomWalk)])
+def test_implicit_model_matches_explicit(machine, bits, sampler, implicit_sampler, walk_class):
+    tm = bundled_machine(machine)
+    model, implicit = sampler(bits, tm).freeze(), implicit_sampler(bits, tm)
+    implicit_nodes = list(implicit.adj_list)
+    assert [node_key(node) for node in implicit_nodes] == [node_key(node) for node in model.nodes]
+    for node, implicit_node in zip(model.nodes, implicit_nodes):
+        assert [node_key(neighbor) for neighbor in implicit.adj_list[implicit_node]] == [node_key(neighbor) for neighbor in model.adj_list[node]]
+    assert [[node_key(node) for node in layer] for layer in implicit.layers] == [[node_key(node) for node in layer] for layer in model.layers]
+    walks = [walk_class(model, 0), walk_class(implicit, 0)]
+    start = walks[0].current_node
+    walks[1].jump_to(implicit_nodes[start.id])
+    walks[0].jump_to(start)
+    for _ in range(30):
+        observations = []
+        for walk in walks:
+            walk.run_for_time(5)
+            ready, node = walk.observe()
+            observations.append((ready, node_key(node)))
+        assert observations[0] == observations[1]
+
+# the empirical relaxation time only walks when it is compared with the spectral one, or there is no spectral one
+@pytest.mark.parametrize("implicit, compare", [(False, False), (False, True), (True, False)])
+def test_analyze_mixing_walks_only_when_needed(implicit, compare):
+    model = (ImplicitLasVegasSampler if implicit else LasVegasSampler)(2, bundled_machine("computation.tm"))
+    walk = LasVegasRandomWalk(model, 0)
+    analysis = analyze_mixing(model, walk, 10, samples=200, compare=compare)
+    assert ("relaxation time (spectral)" in analysis) != implicit
+    assert ("relaxation time (empirical)" in analysis) == (walk.steps > 0) == (implicit or compare)
+    assert relaxation_time(analysis) > 0
@@ -0,0 +1,207 @@
+from turing_machine import TuringMachine, Rules
+from collections.abc import MutableMapping
+import numpy as np
+import os
+
+def tape_string(tape: dict) -> str:
+    return ''.join([value for key, value in sorted(tape.items(), key = lambda x: x[0])])
+
+# Every configuration of a run, stored as per-step deltas: a reversible TM writes at most one cell per step, so
+# step i keeps the head, the state and the (position, symbol) it wrote, if any. Full tapes are rebuilt on demand
+# from the closest checkpoint, taken every CHECKPOINT_INTERVAL steps.
+class Trajectory:
+    CHECKPOINT_INTERVAL = 256
+
+    # runs tm until it halts
+    def __init__(self, tm: TuringMachine):
+        self.states: list[str] = []
+        self.symbols: list[str] = []
+        state_ids, symbol_ids = {}, {}
+        heads, states, write_positions, write_symbols = [tm.head_loc], [], [0], [-1]
+        states.append(state_ids.setdefault(tm.state, len(state_ids)))
+        self.checkpoints: list[dict[int, str]] = [dict(tm.tape)]
+        while True:
+            head, state = tm.head_loc, tm.state
+            if tm.forward(): # when halted
+                break
+            heads.append(tm.head_loc)
+            states.append(state_ids.setdefault(tm.state, len(state_ids)))
+            if tm.rules.forward[state].type == 'rw':
+                write_positions.append(head)
+                write_symbols.append(symbol_ids.setdefault(tm.tape[head], len(symbol_ids)))
+            else:
+                write_positions.append(0)
+                write_symbols.append(-1)
+            if (len(heads) - 1) % self.CHECKPOINT_INTERVAL == 0:
+                self.checkpoints.append(dict(tm.tape))
+        self.states = list(state_ids)
+        self.symbols = list(symbol_ids)
+        self.heads = np.array(heads, dtype=np.int64)
+        self.state_ids = np.array(states, dtype=np.int32)
+        self.write_positions = np.array(write_positions, dtype=np.int64)
+        self.write_symbols = np.array(write_symbols, dtype=np.int32)
+
+    # number of configurations, the computation length plus one
+    def __len__(self) -> int:
+        return len(self.heads)
+
+    def head(self, step: int) -> int:
+        return int(self.heads[step])
+
+    def state(self, step: int) -> str:
+        return self.states[self.state_ids[step]]
+
+    def tape(self, step: int) -> dict[int, str]:
+        checkpoint = step // self.CHECKPOINT_INTERVAL
+        tape = dict(self.checkpoints[checkpoint])
+        first = checkpoint * self.CHECKPOINT_INTERVAL + 1
+        for position, symbol in zip(self.write_positions[first:step + 1].tolist(), self.write_symbols[first:step + 1].tolist()):
+            if symbol >= 0:
+                tape[position] = self.symbols[symbol]
+        return tape
+
+    def tape_string(self, step: int) -> str:
+        return tape_string(self.tape(step))
+
+# the trajectories of one machine as flat arrays, for np.savez. state names and symbols become indices into
+# 'strings', each trajectory's steps (and checkpoints, and cells of each checkpoint) are concatenated and split by
+# the lengths in 'steps' ('checkpoints', 'cells')
+def encode_trajectories(trajectories: list[Trajectory]) -> dict[str, np.ndarray]:
+    string_ids: dict[str, int] = {}
+    def ids(strings: list[str]) -> np.ndarray:
+        return np.array([string_ids.setdefault(string, len(string_ids)) for string in strings] + [-1], dtype=np.int32)
+    state_ids, write_symbols, cell_positions, cell_symbols = [], [], [], []
+    for trajectory in trajectories:
+        state_ids.append(ids(trajectory.states)[trajectory.state_ids])
+        write_symbols.append(ids(trajectory.symbols)[trajectory.write_symbols]) # -1 picks the trailing -1
+        for checkpoint in trajectory.checkpoints:
+            cell_positions.append(np.fromiter(checkpoint.keys(), dtype=np.int64, count=len(checkpoint)))
+            cell_symbols.append(ids(list(checkpoint.values()))[:-1])
+    concatenate = lambda arrays, dtype: np.concatenate(arrays) if arrays else np.zeros(0, dtype=dtype)
+    return {
+        'strings': np.array(list(string_ids), dtype=str),
+        'steps': np.array([len(trajectory) for trajectory in trajectories], dtype=np.int64),
+        'heads': concatenate([trajectory.heads for trajectory in trajectories], np.int64),
+        'state_ids': concatenate(state_ids, np.int32),
+        'write_positions': concatenate([trajectory.write_positions for trajectory in trajectories], np.int64),
+        'write_symbols': concatenate(write_symbols, np.int32),
+        'checkpoints': np.array([len(trajectory.checkpoints) for trajectory in trajectories], dtype=np.int64),
+        'cells': np.array([len(positions) for positions in cell_positions], dtype=np.int64),
+        'cell_positions': concatenate(cell_positions, np.int64),
+        'cell_symbols': concatenate(cell_symbols, np.int32),
+    }
+
+def decode_trajectories(arrays) -> list[Trajectory]:
+    strings: list[str] = arrays['strings'].tolist()
+    split = lambda name, lengths: np.split(arrays[name], np.cumsum(lengths)[:-1]) if len(lengths) else []
+    steps, cells = arrays['steps'], arrays['cells']
+    checkpoint_cells = iter(zip(split('cell_positions', cells), split('cell_symbols', cells)))
+    trajectories = []
+    for heads, state_ids, write_positions, write_symbols, checkpoint_count in zip(
+            split('heads', steps), split('state_ids', steps), split('write_positions', steps), split('write_symbols', steps),
+            arrays['checkpoints'].tolist()):
+        trajectory = Trajectory.__new__(Trajectory)
+        trajectory.states = trajectory.symbols = strings
+        trajectory.heads, trajectory.state_ids = heads, state_ids
+        trajectory.write_positions, trajectory.write_symbols = write_positions, write_symbols
+        trajectory.checkpoints = [dict(zip(positions.tolist(), [strings[i] for i in symbols.tolist()]))
+                                  for positions, symbols in (next(checkpoint_cells) for _ in range(checkpoint_count))]
+        trajectories.append(trajectory)
+    return trajectories
+
+# node data of a computation or output node: 'tape', 'head' and 'state' are read from a step of a shared Trajectory
+# (the tape string is only built when asked for), other keys ('half', 'randomness', 'counter', ...) are stored as usual
+class ComputationData(MutableMapping):
+    __slots__ = ('trajectory', 'step', 'extra')
+    CONFIGURATION_KEYS = ('tape', 'head', 'state')
+
+    def __init__(self, trajectory: Trajectory, step: int, extra: dict = None):
+        self.trajectory = trajectory
+        self.step = step
+        self.extra = extra if extra is not None else {}
+
+    def __getitem__(self, key):
+        if key == 'tape':
+            return self.trajectory.tape_string(self.step)
+        if key == 'head':
+            return self.trajectory.head(self.step)
+        if key == 'state':
+            return self.trajectory.state(self.step)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self.CONFIGURATION_KEYS:
+            raise Exception(f"'{key}' of a computation node comes from its trajectory and can't be changed")
+        self.extra[key] = value
+
+    def __delitem__(self, key):
+        del self.extra[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self.CONFIGURATION_KEYS or key in self.extra
+
+    def __iter__(self):
+        yield from self.CONFIGURATION_KEYS
+        yield from self.extra
+
+    def __len__(self) -> int:
+        return len(self.CONFIGURATION_KEYS) + len(self.extra)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+    # same configuration with other extra keys, e.g. for the output hold nodes
+    def with_extra(self, **extra) -> 'ComputationData':
+        return ComputationData(self.trajectory, self.step, {**self.extra, **extra})
+
+# Memoized trajectories keyed by (rules fingerprint, initial state, head, input tape), so that the two tracks of
+# every HalfHourglass, both halves of a model and longest_computation_path all share one run per input. With a
+# cache_dir, the trajectories of each (rules, initial state) pair are loaded from and saved to one .npz file of
+# plain arrays (see encode_trajectories, never unpickled), which makes them survive across simulate.py invocations
+# on the same .tm file
+class TrajectoryStore:
+    FORMAT = 3 # part of the file names, so that files written with another layout are never loaded
+
+    def __init__(self, cache_dir: str = None):
+        self.cache_dir = cache_dir
+        self.machines: dict[tuple[str, str], dict[tuple, Trajectory]] = {}
+        self.unsaved: set[tuple[str, str]] = set()
+        self.hits = self.misses = 0
+
+    def path(self, machine: tuple[str, str]) -> str:
+        fingerprint, initial_state = machine
+        return os.path.join(self.cache_dir, f"{fingerprint}_{initial_state.encode().hex()}.v{self.FORMAT}.npz")
+
+    def trajectories(self, rules: Rules, initial_state: str) -> dict[tuple, Trajectory]:
+        machine = (rules.fingerprint, initial_state)
+        if machine not in self.machines:
+            self.machines[machine] = {}
+            if self.cache_dir is not None and os.path.exists(self.path(machine)):
+                with np.load(self.path(machine), allow_pickle=False) as arrays:
+                    # a trajectory's key is the configuration it starts from
+                    self.machines[machine] = {(trajectory.head(0), tuple(sorted(trajectory.checkpoints[0].items()))): trajectory
+                                              for trajectory in decode_trajectories(arrays)}
+        return self.machines[machine]
+
+    # the trajectory tm would go through, without running tm itself
+    def get(self, tm: TuringMachine) -> Trajectory:
+        trajectories = self.trajectories(tm.rules, tm.state)
+        key = (tm.head_loc, tuple(sorted(tm.tape.items())))
+        if key in trajectories:
+            self.hits += 1
+        else:
+            self.misses += 1
+            trajectories[key] = Trajectory(TuringMachine(tm.rules, tm.tape, tm.state))
+            self.unsaved.add((tm.rules.fingerprint, tm.state))
+        return trajectories[key]
+
+    def save(self):
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for machine in self.unsaved:
+            temporary = f"{self.path(machine)}.{os.getpid()}.tmp"
+            with open(temporary, 'wb') as file:
+                np.savez(file, **encode_trajectories(list(self.machines[machine].values())))
+            os.replace(temporary, self.path(machine))
+        self.unsaved.clear()
@@ -0,0 +1,81 @@
+from las_vegas import LasVegasSampler, half_codes
+from montecarlo import MonteCarloSampler, reset_masks, output_half_codes
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.linalg import expm_multiply
+
+# Exact versions of the curves in plot.py, computed on the continuous time Markov chain that RandomWalk
+# simulates instead of by repeated trials. Probability mass is pushed forward between measurements with
+# sparse matrix exponential-vector products, and at each measurement the mass that would be observed as
+# ready is removed (a trial stops at its first ready observation) and added to the curve.
+# RandomWalk.run_for_time stops after the first hop that ends past the period, so a walker is observed on the node
+# that hop enters and its next period starts there. The mass is therefore pushed forward by the period and then by
+# one hop to a uniform neighbor. Only the node matters, since the time after the hop is memoryless.
+
+def evolve(generator_t: sp.csr_matrix, state: np.ndarray, time: float) -> np.ndarray:
+    return expm_multiply(generator_t * time, state)
+
+# transpose of the jump chain (a hop to a uniform neighbor) of a frozen model, for pushing distributions forward
+def jump_operator_t(model) -> sp.csr_matrix:
+    _, _, indptr, indices = model.csr_arrays()
+    n = len(indptr) - 1
+    degrees = np.diff(indptr)
+    return sp.csr_matrix((np.repeat(1 / degrees, degrees), indices, indptr), shape=(n, n)).T.tocsr()
+
+# probability that a fresh LasVegasRandomWalk has seen a valid output by its k-th measurement, k = 1..measurements
+def lv_output_ready_probs(model: LasVegasSampler, sampling_period: float, measurements: int) -> np.ndarray:
+    node_half, output_half = half_codes(model)
+    _, _, generator = model.generator()
+    generator_t = generator.T.tocsr()
+    jump_t = jump_operator_t(model)
+    # the walk starts on a uniform node with a half and waits for an output of the other half, one column per half
+    state = np.zeros((len(node_half), 2))
+    for half in range(2):
+        state[node_half == half, half] = 1 / np.count_nonzero(node_half >= 0)
+    targets = [(output_half >= 0) & (output_half != half) for half in range(2)]
+
+    probs = np.zeros(measurements)
+    found = 0.
+    for k in range(measurements):
+        state = jump_t @ evolve(generator_t, state, sampling_period)
+        for half in range(2):
+            found += state[targets[half], half].sum()
+            state[targets[half], half] = 0
+        probs[k] = found
+    return probs
+
+# probability that a MonteCarloRandomWalk started on a uniform node has made an independent observation (one whose
+# outputting half was reset since the start, or since the walker's reset flags say) by its k-th measurement, taken
+# time_increment apart. reset is the walker's flags at the start, like its argument: with both halves reset the
+# first observation is always independent
+def mc_output_ready_probs(model: MonteCarloSampler, time_increment: float, measurements: int, reset: bool = True) -> np.ndarray:
+    top_reset_node, bottom_reset_node = reset_masks(model)
+    output_half = output_half_codes(model)
+    _, _, indptr, indices = model.csr_arrays()
+    n = len(output_half)
+    degrees = np.diff(indptr)
+    # augmented chain on (node, flags) with flag bit 1 = top was reset, bit 2 = bottom was reset,
+    # stored flag-major: state index = flags * n + node. a hop onto a node sets its flags, self-loops included
+    set_flags = np.where(top_reset_node, 1, np.where(bottom_reset_node, 2, 0))
+    rows, cols = np.repeat(np.arange(n), degrees), indices
+    hops = sp.csr_matrix((np.ones(4 * len(rows)), (np.concatenate([flags * n + rows for flags in range(4)]),
+                                                   np.concatenate([(flags | set_flags[cols]) * n + cols for flags in range(4)]))),
+                         shape=(4 * n, 4 * n))
+    augmented = (hops - sp.diags(np.tile(degrees, 4).astype(np.float64))).T.tocsr()
+    jump_t = (sp.diags(np.tile(1 / degrees, 4)) @ hops).T.tocsr()
+
+    if (output_half < 0).any():
+        raise Exception("Monte Carlo node in invalid top/bottom state")
+    ready = np.concatenate([(flags & np.where(output_half == 0, 1, 2)) > 0 for flags in range(4)])
+    state = np.zeros(4 * n)
+    start_flags = 3 if reset else 0
+    state[start_flags * n:(start_flags + 1) * n] = 1 / n
+
+    probs = np.zeros(measurements)
+    found = 0.
+    for k in range(measurements):
+        state = jump_t @ evolve(augmented, state, time_increment)
+        found += state[ready].sum()
+        state[ready] = 0
+        probs[k] = found
+    return probs
@@ -1,3 +1,6 @@
+import numpy as np
+import hashlib
+
 class Rule:
     def __init__(self, typ: str, action = None):
         assert typ in ['move', 'rw']
@@ -25,10 +28,12 @@ class Rule:
 
 class Rules:
     def __init__(self, desc: str):
+        self.fingerprint = hashlib.sha256(desc.encode()).hexdigest()
         # forward rules
         self.forward: dict[str, Rule] = {}
         # reverse rules
         self.reverse: dict[str, Rule] = {}
+        self._compiled: dict[str, CompiledRules] = {}
 
         for line in desc.strip().split('\n'):
             if line.strip().startswith("#") or len(line.strip()) == 0:
@@ -58,10 +63,122 @@ class Rules:
                     raise Exception(f"Conflicting reverse movement rule detected: {line}")
                 self.reverse[next_state] = Rule("move", (rev_direction, state))
         
+    # the forward or reverse rules as CompiledRules, compiled on first use
+    def compiled(self, direction: str) -> 'CompiledRules':
+        if direction not in self._compiled:
+            self._compiled[direction] = CompiledRules(self.forward if direction == 'forward' else self.reverse)
+        return self._compiled[direction]
+
     def __str__(self):
         return "Forward:\n" + "\n".join([str(key) + "->" + str(value) for key, value in self.forward.items()]) + \
             "\nReverse:\n" + "\n".join([str(key) + "->" + str(value) for key, value in self.reverse.items()])
 
+# Rules as dense integer tables. States and symbols are numbered, symbol 0 standing for a cell that was never
+# written (it reads like '_' but is left out of the tape, as in TuringMachine's dict tape). For every state,
+# kind says whether it moves, reads/writes or halts; move states have a head offset and a next state, and
+# read/write states a (next state, written symbol) entry per read symbol, with next state -1 meaning halt.
+class CompiledRules:
+    HALT, MOVE, RW = 0, 1, 2
+
+    def __init__(self, rules: dict[str, Rule], symbols: list[str] = ()):
+        states = set(rules)
+        symbol_set = set(symbols) | {'_'}
+        for rule in rules.values():
+            if rule.type == 'move':
+                states.add(rule.action[1])
+            else:
+                for read, (write, next_state) in rule.action.items():
+                    symbol_set.update([read, write])
+                    states.add(next_state)
+        self.states: list[str] = sorted(states)
+        self.symbols: list[str] = [None] + sorted(symbol_set)
+        self.state_index = {state: i for i, state in enumerate(self.states)}
+        self.symbol_index = {symbol: i for i, symbol in enumerate(self.symbols) if symbol is not None}
+        self.blank = self.symbol_index['_']
+
+        self.kind = np.full(len(self.states), self.HALT, dtype=np.int8)
+        self.move = np.zeros(len(self.states), dtype=np.int64)
+        self.move_next = np.full(len(self.states), -1, dtype=np.int64)
+        self.rw_next = np.full((len(self.states), len(self.symbols)), -1, dtype=np.int64)
+        self.rw_write = np.zeros((len(self.states), len(self.symbols)), dtype=np.uint8)
+        for state, rule in rules.items():
+            i = self.state_index[state]
+            if rule.type == 'move':
+                direction, next_state = rule.action
+                self.kind[i] = self.MOVE
+                self.move[i] = {'L': -1, 'C': 0, 'R': 1}[direction]
+                self.move_next[i] = self.state_index[next_state]
+            else:
+                self.kind[i] = self.RW
+                for read, (write, next_state) in rule.action.items():
+                    self.rw_next[i, self.symbol_index[read]] = self.state_index[next_state]
+                    self.rw_write[i, self.symbol_index[read]] = self.symbol_index[write]
+        self.rw_next[:, 0] = self.rw_next[:, self.blank]
+        self.rw_write[:, 0] = self.rw_write[:, self.blank]
+        # the same tables as lists, for TuringMachine's one step at a time lookups
+        self.kind_list: list[int] = self.kind.tolist()
+        self.move_list: list[int] = self.move.tolist()
+        self.move_next_list: list[int] = self.move_next.tolist()
+        self.rw_next_list: list[list[int]] = self.rw_next.tolist()
+        self.rw_write_list: list[list[int]] = self.rw_write.tolist()
+
+# Runs one machine on many input tapes in lockstep, each step a handful of vectorized table lookups over all
+# machines that haven't halted. Tapes are rows of a uint8 array that grows when a head walks off either end.
+class BatchTuringMachine:
+    def __init__(self, rules: Rules, tapes: list[dict[int, str]], initial_state: str, direction: str = 'forward'):
+        table = rules.forward if direction == 'forward' else rules.reverse
+        self.compiled = CompiledRules(table, sorted({symbol for tape in tapes for symbol in tape.values()}))
+        positions = [position for tape in tapes for position in tape] or [0]
+        self.offset = -min(0, min(positions)) + 1
+        width = self.offset + max(0, max(positions)) + 2
+        self.tape = np.zeros((len(tapes), width), dtype=np.uint8)
+        for row, tape in enumerate(tapes):
+            for position, symbol in tape.items():
+                self.tape[row, position + self.offset] = self.compiled.symbol_index[symbol]
+        self.head_loc = np.zeros(len(tapes), dtype=np.int64)
+        self.state = np.full(len(tapes), self.compiled.state_index.get(initial_state, -1), dtype=np.int64)
+        self.halted = self.state < 0 # a state without rules halts right away, like in TuringMachine
+        self.steps = np.zeros(len(tapes), dtype=np.int64)
+
+    def grow(self, left: int, right: int):
+        self.tape = np.pad(self.tape, ((0, 0), (left, right)))
+        self.offset += left
+
+    # one transition of every running machine, returns the indices of the machines that were running
+    def step(self) -> np.ndarray:
+        compiled = self.compiled
+        active = np.flatnonzero(~self.halted)
+        if len(active) == 0:
+            return active
+        state = self.state[active]
+        columns = self.head_loc[active] + self.offset
+        if columns.min() < 0 or columns.max() >= self.tape.shape[1]:
+            self.grow(self.tape.shape[1], self.tape.shape[1])
+            columns = self.head_loc[active] + self.offset
+        kind = compiled.kind[state]
+        symbol = self.tape[active, columns]
+        next_state = np.where(kind == CompiledRules.MOVE, compiled.move_next[state], compiled.rw_next[state, symbol])
+        halting = (kind == CompiledRules.HALT) | (next_state < 0)
+        self.halted[active[halting]] = True
+
+        moving = ~halting & (kind == CompiledRules.MOVE)
+        self.head_loc[active[moving]] += compiled.move[state[moving]]
+        writing = ~halting & (kind == CompiledRules.RW)
+        self.tape[active[writing], columns[writing]] = compiled.rw_write[state[writing], symbol[writing]]
+        running = active[~halting]
+        self.state[running] = next_state[~halting]
+        self.steps[running] += 1
+        return active
+
+    # runs every machine until it halts, returns the number of transitions each one made before halting
+    def run(self) -> np.ndarray:
+        while len(self.step()) > 0:
+            pass
+        return self.steps.copy()
+
+    def tapes(self) -> list[dict[int, str]]:
+        symbols = self.compiled.symbols
+        return [{int(column) - self.offset: symbols[row[column]] for column in np.flatnonzero(row)} for row in self.tape]
 
 class TuringMachine:
     def __init__(self, rules: Rules, tape: dict[int, int], initial_state: str):
@@ -72,43 +189,49 @@ class TuringMachine:
         self.head_loc = 0
         self.halted = False
     
-    def apply_rule(self, rules: Rules) -> bool:
-        if self.state not in rules: # HALT
-            self.halted = True
-            return True
-        action, next_state = rules[self.state].apply(self.tape.get(self.head_loc, '_'))
-        if next_state == None: # HALT
+    # one transition by the compiled rules, the same lookups BatchTuringMachine.step makes for many machines
+    def apply_rule(self, compiled: CompiledRules) -> bool:
+        state = compiled.state_index.get(self.state, -1)
+        kind = compiled.kind_list[state] if state >= 0 else CompiledRules.HALT
+        if kind == CompiledRules.MOVE:
+            self.head_loc += compiled.move_list[state]
+            next_state = compiled.move_next_list[state]
+        elif kind == CompiledRules.RW:
+            symbol = compiled.symbol_index.get(self.tape.get(self.head_loc, '_'), -1)
+            next_state = compiled.rw_next_list[state][symbol] if symbol >= 0 else -1
+            if next_state >= 0:
+                self.tape[self.head_loc] = compiled.symbols[compiled.rw_write_list[state][symbol]]
+        else:
+            next_state = -1
+        if next_state < 0: # HALT
             self.halted = True
             return True
-        
-        if rules[self.state].type == 'move':
-            if action == 'L':
-                self.head_loc -= 1
-            elif action == 'R':
-                self.head_loc += 1
-        else:
-            self.tape[self.head_loc] = action
-
-        self.state = next_state
+        self.state = compiled.states[next_state]
         return False
 
     def forward(self) -> bool:
-        return self.apply_rule(self.rules.forward)
+        return self.apply_rule(self.rules.compiled('forward'))
     
     def reverse(self) -> bool:
-        return self.apply_rule(self.rules.reverse)
+        return self.apply_rule(self.rules.compiled('reverse'))
 
 def binary_string(n: int, bits: int) -> str:
     return ''.join([str((n >> k) & 1) for k in range(bits-1, -1, -1)])
 
-def longest_computation_path(tm_rules: Rules, initial_state:str, input_length: int) -> int:
+# trajectories is an optional trajectory.TrajectoryStore to take (and leave) the runs from
+def longest_computation_path(tm_rules: Rules, initial_state:str, input_length: int, trajectories = None) -> int:
     print('finding longest computation path of Turing machine, may take forever (google "Halting Problem")')
-    longest = 0
-    for inp in range(2 ** input_length):
-        bstr = binary_string(inp, bits=input_length)
-        tm = TuringMachine(tm_rules, {i:c for i, c in enumerate(bstr)}, initial_state)
-        timer = 0
-        while not tm.forward():
-            timer += 1
-        longest = max(longest, timer)
-    return longest
\ No newline at end of file
+    if trajectories is not None:
+        return max(len(trajectories.get(TuringMachine(tm_rules, {i:c for i, c in enumerate(binary_string(inp, bits=input_length))}, initial_state))) - 1
+                   for inp in range(2 ** input_length))
+    return int(computation_lengths(tm_rules, initial_state, input_length).max())
+
+# number of steps the machine runs for on every input of input_length bits, indexed by the input. the inputs are run
+# chunk_size at a time, so that only the lengths are ever held for all of them
+def computation_lengths(tm_rules: Rules, initial_state: str, input_length: int, chunk_size: int = 1 << 12) -> np.ndarray:
+    lengths = np.zeros(2 ** input_length, dtype=np.int64)
+    for start in range(0, len(lengths), chunk_size):
+        inputs = range(start, min(start + chunk_size, len(lengths)))
+        tapes = [{i:c for i, c in enumerate(binary_string(inp, bits=input_length))} for inp in inputs]
+        lengths[inputs.start:inputs.stop] = BatchTuringMachine(tm_rules, tapes, initial_state).run()
+    return lengths
\ No newline at end of file